@@ -20,6 +20,29 @@ class DefaultConfig:
     RESULTS_NUM_DEFAULT = 100  # Default number of results per query set in the search form
     RESULTS_NUM_MAX = 1000  # Maximum number of results per query
     TIME_FORMAT = '{:%Y-%m-%d %H:%M:%S}'  # Time format to show in IRC logs, should be Python .format() compatible
+    # Use PostgreSQL full-text search for keyword queries without wildcards. Much faster on large backlogs, but matches
+    # whole words only (no partial words). Requires PostgreSQL >= 9.6 and the full-text indices, which are only built by
+    # `create_indices --fulltext` (build them before enabling this).
+    QF_FULLTEXT_SEARCH = False
+    QF_FULLTEXT_CONFIG = 'simple'  # PostgreSQL text search configuration; if changed, rebuild the full-text indices
+    QF_PERMISSION_CACHE_BUFFER_CHECK = 60  # seconds - how often cached user permissions check for new Quassel buffers
+    QF_USERMASK_SENDERIDS_MAX = 5000  # usermask searches matching more senders than this search via the sender table
+    QF_USERMASK_CACHE_TTL = 300  # seconds - how long to cache the senders matching a usermask search
+    # days - newest-first searches scan backwards in time windows of these sizes, stopping once enough results are found
+    # Set to () to search the whole backlog in a single query.
+    QF_SEARCH_WINDOWS = (1, 7, 30, 365)
+    # filter and sort time-bounded searches by the messageid range of start/end instead of by time. Faster, but only
+    # correct if messageids are in time order, which imported or merged Quassel databases don't guarantee.
+    QF_MESSAGEID_TIME_RANGE = False
+    QF_BUFFER_STATS_TTL = 3600  # seconds - how often to reload per-buffer backlog size estimates (to choose a plan)
+    QF_RESULT_CACHE_MAX_BYTES = 32*1024*1024  # approx. memory used to cache search results (per process); 0 to disable
+    QF_RESULT_CACHE_TTL = 60  # seconds - how long to cache search results that may still change (new messages)
+    QF_BUFFER_NAMES_TTL = 300  # seconds - how often to reload buffer and network names (renames show after this delay)
+    QF_SENDER_CACHE_SIZE = 100000  # number of senders (nick!user@host) to cache for displaying results (per process)
+    QF_STREAM_RESULTS = True  # send search results pages to the browser while they are rendered
+    QF_EXPORT_BATCH_SIZE = 1000  # number of results fetched from the database at a time for /search/logs/export
+    QF_CONTEXT_LINES = 10  # number of lines before and after a result to show when opening its context
+    QF_CONTEXT_MAX = 20  # maximum number of lines of context around each result in search results
     SECRET_KEY = ''  # IMPORTANT: Set this for security! See documentation
 
     QF_PASSWORD_MIN = 12  # Minimum password length for Quasselflask users
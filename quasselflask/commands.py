@@ -5,7 +5,9 @@ Project: Quasselflask
 """
 
 from sys import stderr
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
+import os
 import time
 
 import sqlalchemy.orm
@@ -109,46 +111,226 @@ def create_superuser(name, email, password=''):
 
 
 @cmdman.command
-def create_indices():
+def create_indices(message_trigram=False, fulltext=False, index='', processes='4', lock=False):
     """
-    Create all indices used for QuasselFlask searches.
-    :return:
-    :raise Exception: SQLAlchemy exceptions???
+    Create all indices used for QuasselFlask searches. Indices that already exist are skipped: run this again after
+    upgrading QuasselFlask to create any new indices (indices of earlier versions that they make redundant are then
+    dropped), or to resume after an interruption.
+
+    Indices are built without blocking writes to the tables (quasselcore can keep running), and builds on different
+    tables run in parallel.
+
+    :param message_trigram: Also create the trigram index on backlog messages, which speeds up keyword searches with
+        wildcards (and without, if full-text search is disabled). This index is about as large as the backlog itself.
+    :param fulltext: Also create the full-text indices on backlog messages (all messages, and conversation messages
+        only), needed for full-text keyword searches (QF_FULLTEXT_SEARCH).
+    :param index: Only create these indices: index name or wildcard pattern (e.g. qf_backlog_time_idx,
+        'qf_backlog_conversation_*'), message_trigram, fulltext or fulltext_conversation.
+    :param processes: Maximum number of indices built at the same time (each uses one database connection). Default 4.
+    :param lock: Lock the tables against writes while building (stop quasselcore first). This is faster, and lets
+        builds on the same table run in parallel.
     """
     from quasselflask.models import models
+    try:
+        names = [match.name for match in models.find_indices(index)] if index else None
+        num_processes = int(processes)
+    except (KeyError, ValueError) as e:
+        raise InvalidCommand(e.args[0])
+    optional = []
+    if message_trigram:
+        optional.append('message_trigram')
+    if fulltext:
+        optional.extend(['fulltext', 'fulltext_conversation'])
     if prompt_bool(
             'Are you sure? This will build new indices to speed up QuasselFlask searches. DEPENDING ON QUASSEL '
-            'BACKLOG SIZE, THIS CAN TAKE SEVERAL MINUTES. If indices were already built, you should run '
-            '`drop_indices` first to drop them. (y|n) Default:'):
+            'BACKLOG SIZE, THIS CAN TAKE SEVERAL MINUTES. (y|n) Default:'):
         print('Creating indices. This may take several minutes. Please wait...')
         _timer_start()
-        models.qf_create_indices()
-        print('Database indices for QuasselFlask created. (Existing indices have not been changed).')
+
+        def print_progress(name, message):
+            print('[{:.0f}s] {}: {}'.format(time.time() - _start_time, name, message))
+
+        created = models.qf_create_indices(optional, names, concurrently=not lock, processes=num_processes,
+                                           progress=print_progress)
+        print('Database indices for QuasselFlask created: {:d}. (Existing indices have not been changed).'
+              .format(len(created)))
         _timer_print()
     else:
         print('Cancelled by user. Database has not been modified.')
 
 
 @cmdman.command
-def reset_indices():
+def reset_indices(index=''):
     """
     Drop all search indices made specifically for QuasselFlask. This should not affect the database objects for your
     quasselcore installation---but use at your own risk and have backups anyway!
+    :param index: Only drop these indices: index name or wildcard pattern (e.g. qf_backlog_time_idx,
+        'qf_backlog_conversation_*'), message_trigram, fulltext or fulltext_conversation.
     :return:
     """
     from quasselflask.models import models
-    if prompt_bool('Are you sure? This will delete all QuasselFlask-specific search indices and CANNOT BE UNDONE. '
+    try:
+        names = [match.name for match in models.find_indices(index)] if index else None
+    except KeyError as e:
+        raise InvalidCommand(e.args[0])
+    if prompt_bool('Are you sure? This will delete {} and CANNOT BE UNDONE. '
                    'Quassel database will not be deleted. You will need to run the "create_indices" '
-                   'command again to create the indices. (y|n) Default:'):
+                   'command again to create the indices. (y|n) Default:'
+                   .format('the indices ' + ', '.join(names) if names else 'all QuasselFlask-specific search indices')):
         print('Dropping indices...')
         _timer_start()
-        models.qf_drop_indices()
+        models.qf_drop_indices(names)
         print('Database indices for QuasselFlask search dropped.')
         _timer_print()
     else:
         print('Cancelled by user. Database has not been modified.')
 
 
+@cmdman.command
+def export_archive(output, user='', state='', processes='4'):
+    """
+    Export IRC logs of channels into an archive of text files: one file per network, channel and day, in the same
+    format as the text export of search results. Channels are exported in parallel.
+
+    :param output: Path of the archive file to create. The format is determined by the extension: .zip, .tar, .tar.gz or
+        .tgz.
+    :param user: QuasselFlask username. If specified, only exports the channels that this user is permitted to search.
+        Otherwise, exports all channels.
+    :param state: Path of a state file for incremental exports. If the file exists, only messages newer than those
+        exported by the last run with the same state file are exported. The file is created or updated once the export
+        is complete.
+    :param processes: Number of worker processes (each uses one database connection). Default 4.
+    """
+    from quasselflask.models.archive import export_archive as _export_archive, get_archive_format
+    from quasselflask.models.models import QfUser
+    from quasselflask.models.query import query_permitted_bufferids
+
+    try:
+        get_archive_format(output)
+        num_processes = int(processes)
+    except ValueError as e:
+        raise InvalidCommand(str(e))
+
+    bufferids = None
+    if user:
+        qfuser = db.session.query(QfUser).filter_by(username=user).one_or_none()
+        if qfuser is None:
+            raise InvalidCommand('User not found: ' + user)
+        bufferids = frozenset(query_permitted_bufferids(db.session, qfuser))
+
+    watermarks = {}
+    if state and os.path.exists(state):
+        with open(state, encoding='utf-8') as f:
+            watermarks = {int(bufferid): messageid for bufferid, messageid in json.load(f)['watermarks'].items()}
+        print('Incremental export: exporting messages newer than the last export in {}.'.format(state))
+
+    def print_progress(num_done, num_total, bufferid, num_messages):
+        print('[{:d}/{:d}] Buffer {:d}: {:d} messages'.format(num_done, num_total, bufferid, num_messages))
+
+    _timer_start()
+    watermarks = _export_archive(output, bufferids, watermarks, num_processes, app.config['QF_EXPORT_BATCH_SIZE'],
+                                 print_progress)
+    print('Exported archive: ' + output)
+
+    if state:
+        with open(state + '.part', 'w', encoding='utf-8') as f:
+            json.dump({'watermarks': {str(bufferid): messageid for bufferid, messageid in watermarks.items()}}, f)
+        os.replace(state + '.part', state)
+        print('Updated state file: ' + state)
+    _timer_print()
+
+
+@cmdman.command
+def explain_searches(samples='3', analyze=False):
+    """
+    Show which indices the database uses for typical searches: searches of one or several channels, of a sender, of a
+    channel and sender, of a time range, of all message types, of all channels, and of a keyword. Channels, senders and
+    keywords are sampled from the newest messages in the backlog. Use this to check that the QuasselFlask indices are
+    used (see create_indices).
+
+    Only the first query of each search is shown: the search may run more queries over older time windows if it finds
+    too few results (see QF_SEARCH_WINDOWS).
+
+    :param samples: Number of samples of each kind of search. Default 3.
+    :param analyze: Also run each search, and show its execution time.
+    """
+    import random
+    from sqlalchemy import desc
+    from werkzeug.datastructures import MultiDict
+    from quasselflask.models import query
+    from quasselflask.models.models import Backlog, Buffer, Sender, indices, optional_indices
+    from quasselflask.parsing.form import process_search_params
+    from quasselflask.parsing.irclog import BufferType
+
+    try:
+        num_samples = int(samples)
+    except ValueError as e:
+        raise InvalidCommand(str(e))
+
+    recent = db.session.query(Buffer.buffername, Sender.sender, Backlog.message, Backlog.time)\
+        .join(Buffer, Buffer.bufferid == Backlog.bufferid)\
+        .join(Sender, Sender.senderid == Backlog.senderid)\
+        .filter(Buffer.buffertype == BufferType.channel_buffer.value)\
+        .order_by(desc(Backlog.time))\
+        .limit(1000)\
+        .all()
+    if not recent:
+        raise InvalidCommand('No channel messages in the backlog.')
+    channels = sorted({_escape_glob(row.buffername) for row in recent})
+    usermasks = sorted({_escape_glob(row.sender.split('!')[0]) + '!*' for row in recent})
+    keywords = sorted({word for row in recent for word in (row.message or '').split() if word.isalnum() and
+                       len(word) >= 4})
+    week_ago = (recent[0].time - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+
+    searches = [('All channels', {})]
+    for _ in range(num_samples):
+        searches.extend([
+            ('Channel', {'channel': random.choice(channels)}),
+            ('Channels', {'channel': ' '.join(random.sample(channels, min(3, len(channels))))}),
+            ('Sender', {'usermask': random.choice(usermasks)}),
+            ('Channel and sender', {'channel': random.choice(channels), 'usermask': random.choice(usermasks)}),
+            ('Channel, last 7 days', {'channel': random.choice(channels), 'start': week_ago, 'order': 'oldest'}),
+            ('Channel, all message types', {'channel': random.choice(channels), 'types': 'all'}),
+        ])
+        if keywords:
+            searches.append(('Keyword', {'query': random.choice(keywords)}))
+
+    entities = query.backlog_key_columns if app.config['QF_STREAM_RESULTS'] else query.backlog_row_columns
+    windows = [timedelta(days=days) for days in app.config['QF_SEARCH_WINDOWS']]
+    index_uses = {index.name: 0 for index in indices | set(optional_indices.values())
+                  if index.table is Backlog.__table__}
+    _timer_start()
+    for label, form in searches:
+        args = process_search_params(MultiDict(form))
+        args['permissions'] = None
+        args['bufferids'] = query.resolve_search_bufferids(db.session, args)
+        args['senderids'] = query.resolve_search_senderids(db.session, args, app.config['QF_USERMASK_SENDERIDS_MAX'])
+        if app.config['QF_MESSAGEID_TIME_RANGE']:
+            args['messageid_range'] = query.resolve_search_messageid_range(db.session, args)
+        print('{}: {}'.format(label, ' '.join('{}={}'.format(key, value) for key, value in sorted(form.items()))))
+        if query.is_search_empty(args):
+            print('    No results (no matching channel or sender).')
+            continue
+        args['plan'] = query.choose_backlog_plan(db.session, args, app.config['QF_BUFFER_STATS_TTL'])
+        scans, execution_time = query.explain_backlog_search(db.session, args, entities, analyze, windows)
+        print('    Plan: {}{}'.format(args['plan'], ', {:.3f} ms'.format(execution_time) if analyze else ''))
+        for scan_type, name in scans:
+            print('    {} on {}'.format(scan_type, name))
+            if name in index_uses:
+                index_uses[name] += 1
+
+    print('\nSearches using each index ({:d} searches):'.format(len(searches)))
+    name_width = max(len(name) for name in index_uses)
+    for name, num_uses in sorted(index_uses.items()):
+        print('    {:<{}} {:d}'.format(name, name_width, num_uses))
+    _timer_print()
+
+
+def _escape_glob(s: str) -> str:
+    """ Escape wildcard characters in a string, for use as a search form glob. """
+    return s.replace('\\', '\\\\').replace('*', '\\*').replace('?', '\\?')
+
+
 def _format_form_errors(errors: {str: [str]}) -> [str]:
     """
 
@@ -0,0 +1,190 @@
+"""
+Offline export of IRC logs into archives of per-channel, per-day text files.
+
+Project: QuasselFlask
+"""
+
+import contextlib
+import itertools
+import multiprocessing
+import os
+import re
+import tarfile
+import tempfile
+import zipfile
+
+from sqlalchemy import select, and_, asc, bindparam
+
+from quasselflask import app, db
+from quasselflask.models.models import Backlog, Buffer, Network, Sender
+from quasselflask.parsing.irclog import BufferType, DisplayBacklog
+
+archive_formats = {
+    # format: (file extensions, tarfile mode or None for zip)
+    'zip': (('.zip',), None),
+    'tar': (('.tar',), 'w'),
+    'tar.gz': (('.tar.gz', '.tgz'), 'w:gz'),
+}
+
+_worker_engine = None  # engine used by worker processes, inherited from the parent process when forking
+
+
+def get_archive_format(path: str) -> str:
+    """
+    Determine the archive format from a file name.
+    :param path: Archive file path
+    :return: Key of ``archive_formats``
+    :raise ValueError: Unknown file extension
+    """
+    for archive_format, (extensions, _) in archive_formats.items():
+        if path.lower().endswith(extensions):
+            return archive_format
+    raise ValueError('Unknown archive format (must be one of {}): {}'.format(
+        ', '.join(ext for extensions, _ in archive_formats.values() for ext in extensions), path))
+
+
+def export_archive(output: str, bufferids=None, watermarks: {int: int}=None, processes: int=4, batch_size: int=1000,
+                   progress=None) -> {int: int}:
+    """
+    Export the backlog of channel buffers into an archive of text files, one per network, channel and day
+    (``network/#channel/YYYY-MM-DD.txt``), in the same format as the text export of search results.
+
+    Buffers are exported in parallel by a pool of worker processes, each with its own database connection reading the
+    buffer's backlog from a server-side cursor. Worker processes write each buffer's files to a temporary directory,
+    and the files are added to the archive as each buffer is completed.
+
+    The archive is written to a temporary file, which only replaces ``output`` once the export is complete.
+
+    :param output: Path of the archive to create. Format is determined by the extension (see ``archive_formats``).
+    :param bufferids: Iterable of bufferids of the channel buffers to export, or None for all channel buffers.
+    :param watermarks: dict of {bufferid: messageid}. Only messages newer than the watermark messageid are exported,
+        e.g. to create incremental archives of messages since the last export. Buffers not in the dict are exported
+        from the beginning.
+    :param processes: Number of worker processes. If 1, buffers are exported in this process.
+    :param batch_size: Number of messages fetched from the database at a time.
+    :param progress: Callable taking (number of buffers completed, total number of buffers, bufferid, number of messages
+        exported from that buffer), called as each buffer is completed.
+    :return: The new watermarks: dict of {bufferid: messageid}, including the buffers that had no new messages.
+    """
+    global _worker_engine
+    archive_format = get_archive_format(output)
+    watermarks = dict(watermarks or {})
+
+    query = db.session.query(Buffer.bufferid, Buffer.buffername, Network.networkname)\
+        .join(Network, Network.networkid == Buffer.networkid)\
+        .filter(Buffer.buffertype == BufferType.channel_buffer.value)\
+        .order_by(Buffer.bufferid)
+    buffers = [(bufferid, buffername, networkname) for bufferid, buffername, networkname in query
+               if bufferids is None or bufferid in bufferids]
+    archive_dirs = _get_archive_dirs(buffers)
+
+    # don't share open database connections with worker processes: each worker opens its own
+    db.session.close()
+    db.engine.dispose()
+    _worker_engine = db.engine
+
+    output_part = output + '.part'
+    with tempfile.TemporaryDirectory(prefix='quasselflask-') as work_dir:
+        tasks = [(bufferid, buffername, networkname, archive_dirs[bufferid], watermarks.get(bufferid, 0),
+                  work_dir, batch_size) for bufferid, buffername, networkname in buffers]
+        if processes > 1:
+            pool = multiprocessing.get_context('fork').Pool(processes)
+            results = pool.imap_unordered(_export_buffer, tasks)
+        else:
+            pool = None
+            results = map(_export_buffer, tasks)
+
+        try:
+            with _open_archive(output_part, archive_format) as add_file:
+                for i, (bufferid, files, last_messageid, num_messages) in enumerate(results, 1):
+                    for arcname, path in files:
+                        add_file(path, arcname)
+                        os.remove(path)
+                    watermarks[bufferid] = last_messageid
+                    if progress:
+                        progress(i, len(tasks), bufferid, num_messages)
+        except BaseException:
+            if os.path.exists(output_part):
+                os.remove(output_part)
+            raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    os.replace(output_part, output)
+    return watermarks
+
+
+@contextlib.contextmanager
+def _open_archive(path: str, archive_format: str):
+    """
+    Context manager to open an archive for writing. Yields a function taking (path, arcname) that adds a file to the
+    archive.
+    """
+    tar_mode = archive_formats[archive_format][1]
+    if tar_mode is None:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            yield archive.write
+    else:
+        with tarfile.open(path, tar_mode) as archive:
+            yield archive.add
+
+
+def _get_archive_dirs(buffers: [(int, str, str)]) -> {int: str}:
+    """
+    Get the archive directory of each buffer (``network/channel``), with any characters not safe for file names
+    replaced. If several buffers have the same directory (e.g. same network and channel names for different Quassel
+    users, or channel names differing only by case), the bufferid is appended to disambiguate.
+    :param buffers: Iterable of (bufferid, buffername, networkname)
+    :return: dict of {bufferid: directory}
+    """
+    dirs = {bufferid: _sanitize_path_component(networkname) + '/' + _sanitize_path_component(buffername)
+            for bufferid, buffername, networkname in buffers}
+    counts = {}
+    for dir_ in dirs.values():
+        counts[dir_.lower()] = counts.get(dir_.lower(), 0) + 1
+    return {bufferid: dir_ if counts[dir_.lower()] == 1 else '{}-{:d}'.format(dir_, bufferid)
+            for bufferid, dir_ in dirs.items()}
+
+
+def _sanitize_path_component(name: str) -> str:
+    name = re.sub(r'[\x00-\x1f/\\:*?"<>|]', '_', name or '')
+    return name if name.strip('.') else '_' + name
+
+
+def _export_buffer(task: tuple) -> (int, [(str, str)], int, int):
+    """
+    Export a buffer's backlog into per-day text files. Runs in a worker process.
+    :param task: (bufferid, buffername, networkname, archive directory, watermark messageid, working directory,
+        batch size)
+    :return: (bufferid, list of (archive name, file path), last exported messageid, number of messages exported). If no
+        messages were exported, the last exported messageid is the watermark.
+    """
+    bufferid, buffername, networkname, archive_dir, last_messageid, work_dir, batch_size = task
+    template = app.jinja_env.get_template('results.txt')
+    files = {}  # {date: path}
+    num_messages = 0
+
+    query = select([Backlog.messageid, Backlog.time, Backlog.type, Backlog.message, Sender.sender])\
+        .select_from(Backlog.__table__.join(Sender.__table__, Sender.senderid == Backlog.senderid))\
+        .where(and_(Backlog.bufferid == bindparam('bufferid'), Backlog.messageid > bindparam('messageid')))\
+        .order_by(asc(Backlog.messageid))
+
+    with _worker_engine.connect() as connection:
+        results = connection.execution_options(stream_results=True)\
+            .execute(query, bufferid=bufferid, messageid=last_messageid)
+        while True:
+            rows = results.fetchmany(batch_size)
+            if not rows:
+                break
+            for date, day_rows in itertools.groupby(rows, key=lambda row: row.time.date()):
+                records = [DisplayBacklog(row, row.sender, buffername, networkname) for row in day_rows]
+                path = files.setdefault(date, os.path.join(work_dir, '{:d}-{}.txt'.format(bufferid, date.isoformat())))
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(template.render(records=records, expand_line_details=False))
+            num_messages += len(rows)
+            last_messageid = rows[-1].messageid
+
+    archive_files = [('{}/{}.txt'.format(archive_dir, date.isoformat()), path) for date, path in sorted(files.items())]
+    return bufferid, archive_files, last_messageid, num_messages
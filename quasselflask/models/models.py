@@ -5,15 +5,23 @@ in case of future quassel changes (especially schema changes that don't affect q
 Project: QuasselFlask
 """
 
+import concurrent.futures
+import fnmatch
+import re
+import threading
+import time
+
 from flask_login import AnonymousUserMixin
 from flask_user import UserMixin
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy import Index, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm import Query
 
-from quasselflask import db
+from quasselflask import app, db
 from quasselflask.models.types import PermissionAccess, PermissionType
-from quasselflask.parsing.irclog import BacklogType
+from quasselflask.parsing.irclog import BacklogType, conversation_backlog_types
 
 _db_tables = ['backlog', 'sender', 'buffer', 'network', 'quasseluser']
 db.metadata.reflect(db.engine, only=_db_tables)
@@ -37,15 +45,60 @@ def __repr_backlog(self):
 
 Backlog.__repr__ = __repr_backlog
 
+# Text search configuration for full-text searches. The search expression must match the index expression exactly for
+# the index to be used, so both are built from this value.
+fulltext_config = app.config.get('QF_FULLTEXT_CONFIG', 'simple')
+if not re.match(r'^[A-Za-z_][A-Za-z0-9_.]*$', fulltext_config):
+    raise ValueError('Invalid QF_FULLTEXT_CONFIG text search configuration name: ' + repr(fulltext_config))
+
+# Restricts partial indices to the conversation message types, so that searches of those types (the default) scan
+# only the part of the backlog that they can match. See query._apply_backlog_search_filter().
+_conversation_where = Backlog.type.in_(sorted(backlog_type.value for backlog_type in conversation_backlog_types))
+
 indices = {
     Index('qf_sender_gin_sender_idx', text("sender gin_trgm_ops"), postgresql_using='gin'),
     Index('qf_buffer_gin_buffername_idx', text("buffername gin_trgm_ops"), postgresql_using='gin'),
     Index('qf_backlog_time_idx', Backlog.time),
     Index('qf_backlog_bufferid_senderid_idx', Backlog.bufferid, Backlog.senderid),
-    Index('qf_backlog_senderid_idx', Backlog.senderid),
+    # Context of a message, and searches of a buffer in messageid order (see query.resolve_search_messageid_range)
+    Index('qf_backlog_bufferid_messageid_time_senderid_idx', Backlog.bufferid, Backlog.messageid, Backlog.time,
+          Backlog.senderid),
+    # Searches of a buffer or sender in time order (see query.choose_backlog_plan). The columns after time and
+    # messageid are only there so that the result keys (query.backlog_key_columns) can be read from the index alone
+    # (index-only scan).
+    Index('qf_backlog_bufferid_time_messageid_senderid_idx', Backlog.bufferid, Backlog.time, Backlog.messageid,
+          Backlog.senderid),
+    Index('qf_backlog_senderid_time_idx', Backlog.senderid, Backlog.time, Backlog.messageid, Backlog.bufferid),
+    # Same as above, restricted to conversation messages. The indices above are still used to search all message types,
+    # and to show the context of search results.
+    Index('qf_backlog_conversation_time_idx', Backlog.time, Backlog.messageid, postgresql_where=_conversation_where),
+    Index('qf_backlog_conversation_bufferid_messageid_idx', Backlog.bufferid, Backlog.messageid, Backlog.time,
+          Backlog.senderid, postgresql_where=_conversation_where),
+    Index('qf_backlog_conversation_bufferid_time_idx', Backlog.bufferid, Backlog.time, Backlog.messageid,
+          Backlog.senderid, postgresql_where=_conversation_where),
+    Index('qf_backlog_conversation_senderid_time_idx', Backlog.senderid, Backlog.time, Backlog.messageid,
+          Backlog.bufferid, postgresql_where=_conversation_where),
+}
+
+# Indices that are only created on request, because of their size. Keys are the names used to request them.
+optional_indices = {
+    # Substring and wildcard keyword searches (LIKE). Typically as large as the backlog table itself.
+    'message_trigram': Index('qf_backlog_gin_message_idx', text("message gin_trgm_ops"), postgresql_using='gin'),
+    # Full-text keyword searches (QF_FULLTEXT_SEARCH). Unused if full-text search is disabled.
+    'fulltext': Index('qf_backlog_gin_message_tsv_idx', text("to_tsvector('{}', message)".format(fulltext_config)),
+                      postgresql_using='gin'),
+    'fulltext_conversation': Index('qf_backlog_conversation_gin_message_tsv_idx',
+                                   text("to_tsvector('{}', message)".format(fulltext_config)),
+                                   postgresql_using='gin', postgresql_where=_conversation_where),
 }
 
-for index in indices:
+# Indices of earlier versions that are now redundant, dropped by qf_create_indices() (when creating the default indices)
+# and qf_drop_indices().
+replaced_index_names = {
+    'qf_backlog_senderid_idx',  # (senderid): a prefix of qf_backlog_senderid_time_idx
+}
+
+for index in indices | set(optional_indices.values()):
     if index.name.startswith('qf_sender'):
         Sender.__table__.append_constraint(index)
     elif index.name.startswith('qf_buffer'):
@@ -291,21 +344,221 @@ def qf_drop_tables():
     db.Enum(PermissionType).drop(db.engine, checkfirst=True)
 
 
-def qf_create_indices():
+def get_index(name: str) -> Index:
     """
-    Create all indices used for QuasselFlask searches.
+    Look up a QuasselFlask index by name.
+    :param name: Index name (e.g. 'qf_backlog_time_idx'), or key of ``optional_indices`` (e.g. 'message_trigram')
     :return:
-    :raise Exception: SQLAlchemy exceptions???
+    :raise KeyError: Unknown index name.
+    """
+    if name in optional_indices:
+        return optional_indices[name]
+    for index in indices | set(optional_indices.values()):
+        if index.name == name:
+            return index
+    raise KeyError('Unknown index: ' + name)
+
+
+def find_indices(pattern: str) -> [Index]:
+    """
+    Look up QuasselFlask indices by name, allowing wildcards.
+    :param pattern: Index name or glob pattern (e.g. 'qf_backlog_*'), or key of ``optional_indices``
+    :return: Matching indices, sorted by name
+    :raise KeyError: No index matches.
+    """
+    if pattern in optional_indices:
+        return [optional_indices[pattern]]
+    matches = sorted((index for index in indices | set(optional_indices.values())
+                      if fnmatch.fnmatchcase(index.name, pattern)), key=lambda index: index.name)
+    if not matches:
+        raise KeyError('Unknown index: ' + pattern)
+    return matches
+
+
+def qf_create_indices(optional=tuple(), names=None, concurrently=True, processes=4, progress=None,
+                      progress_interval=10) -> [str]:
+    """
+    Create the indices used for QuasselFlask searches. Indices that already exist are skipped, so this can be run again
+    to create new or missing indices, or to resume after an interruption. Invalid indices left over by an interrupted
+    concurrent build are dropped and rebuilt. When creating the default indices, indices of earlier versions that they
+    make redundant (``replaced_index_names``) are then dropped.
+
+    Indices are built in parallel by a pool of threads, each with its own database connection.
+
+    :param optional: Iterable of keys of ``optional_indices`` to create in addition to the default indices.
+    :param names: Iterable of names of the indices to create (see ``get_index()``), instead of the default and
+        ``optional`` indices.
+    :param concurrently: Build with CREATE INDEX CONCURRENTLY, which doesn't block writes to the tables (quasselcore can
+        keep running), but takes longer. Concurrent builds on the same table can't run in parallel, so only indices on
+        different tables are built in parallel. If False, builds lock the tables against writes, but all indices are
+        built in parallel.
+    :param processes: Maximum number of indices built at the same time.
+    :param progress: Callable taking (index name, message), called when a build starts or ends, and every
+        ``progress_interval`` seconds with the progress of the builds (PostgreSQL >= 12). Calls are serialized.
+    :param progress_interval: Seconds between progress reports.
+    :return: Names of the indices created
+    :raise KeyError: Unknown index name.
+    """
+    if names is not None:
+        create_indices = {get_index(name) for name in names}
+    else:
+        create_indices = indices | {optional_indices[name] for name in optional}
+
+    # builds run in groups, each group in order on one connection
+    if concurrently:
+        groups = {}
+        for index in sorted(create_indices, key=lambda index: index.name):
+            groups.setdefault(index.table.name, []).append(index)
+        groups = list(groups.values())
+    else:
+        groups = [[index] for index in sorted(create_indices, key=lambda index: index.name)]
+
+    if progress is not None:
+        progress_lock = threading.Lock()
+        report_progress = progress
+
+        def progress(name, message):  # called from several threads
+            with progress_lock:
+                report_progress(name, message)
+
+    building = {}  # backend pid: name of the index it's building
+    reported = {}  # index name: last progress message
+    report_builds = progress is not None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_create_indices, group, concurrently, building, progress) for group in groups]
+        pending = futures
+        while pending:
+            _, pending = concurrent.futures.wait(pending, timeout=progress_interval)
+            if pending and report_builds and building:
+                if not _report_index_progress(building, reported, progress):
+                    report_builds = False  # progress view not available
+        created = [name for future in futures for name in future.result()]
+
+    if names is None:
+        _drop_replaced_indices(concurrently, progress)
+    return created
+
+
+def _drop_replaced_indices(concurrently: bool, progress):
     """
-    # TODO qf_create_indices()
-    for index in indices:
-        index.create(bind=db.engine)
+    Drop the indices of earlier versions in ``replaced_index_names`` that exist. See ``qf_create_indices()``.
+    :param concurrently: Use DROP INDEX CONCURRENTLY.
+    :param progress: Progress callable, or None.
+    :return: None
+    """
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        for name in sorted(replaced_index_names):
+            if connection.execute(text('SELECT to_regclass(:name) IS NOT NULL'), name=name).scalar():
+                if progress is not None:
+                    progress(name, 'dropping index replaced by a newer index')
+                connection.execute(_get_drop_index_sql(name, concurrently))
+
+
+def _create_indices(group: [Index], concurrently: bool, building: {int: str}, progress) -> [str]:
+    """
+    Create indices one after the other, on a new database connection. See ``qf_create_indices()``.
+    :param group: Indices to create
+    :param concurrently: Use CREATE INDEX CONCURRENTLY.
+    :param building: dict of {backend pid: index name}, updated with the index being built
+    :param progress: Progress callable, or None.
+    :return: Names of the indices created
+    """
+    created = []
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')  # CONCURRENTLY: not in a transaction
+        pid = connection.execute(text('SELECT pg_backend_pid()')).scalar()
+        for index in group:
+            is_valid = _get_index_validity(connection, index)
+            if is_valid:
+                if progress is not None:
+                    progress(index.name, 'already exists')
+                continue
+            elif is_valid is not None:
+                if progress is not None:
+                    progress(index.name, 'dropping invalid index left by an interrupted build')
+                connection.execute(_get_drop_index_sql(index.name, concurrently))
+
+            if progress is not None:
+                progress(index.name, 'building')
+            start_time = time.monotonic()
+            building[pid] = index.name
+            try:
+                connection.execute(_get_create_index_sql(index, concurrently))
+            finally:
+                del building[pid]
+            created.append(index.name)
+            if progress is not None:
+                progress(index.name, 'created in {:.1f}s'.format(time.monotonic() - start_time))
+    return created
+
+
+def _report_index_progress(building: {int: str}, reported: {str: str}, progress) -> bool:
+    """
+    Report the progress of index builds, from ``pg_stat_progress_create_index``.
+    :param building: dict of {backend pid: index name}
+    :param reported: dict of {index name: last progress message}, updated. Unchanged progress isn't reported again.
+    :param progress: Progress callable
+    :return: False if the progress view is not available (PostgreSQL < 12).
+    """
+    building = dict(building)
+    try:
+        rows = db.engine.execute(text("""
+            SELECT pid, phase, blocks_done, blocks_total, tuples_done, tuples_total
+            FROM pg_stat_progress_create_index WHERE pid = ANY(:pids)"""), pids=list(building)).fetchall()
+    except DBAPIError:
+        return False
+    for row in rows:
+        if row.blocks_total:
+            done = ' ({:.0%})'.format(row.blocks_done / row.blocks_total)
+        elif row.tuples_total:
+            done = ' ({:.0%})'.format(row.tuples_done / row.tuples_total)
+        else:
+            done = ''
+        name, message = building[row.pid], row.phase + done
+        if reported.get(name) != message:
+            reported[name] = message
+            progress(name, message)
+    return True
 
 
-def qf_drop_indices():
+def qf_drop_indices(names=None, concurrently=True):
     """
-    Drop all search indices made specifically for QuasselFlask.
+    Drop search indices made specifically for QuasselFlask that exist, including any optional indices that were created
+    and indices of earlier versions (``replaced_index_names``).
+    :param names: Iterable of names of the indices to drop (see ``get_index()``), instead of all indices.
+    :param concurrently: Use DROP INDEX CONCURRENTLY, which doesn't block reads and writes to the tables.
     :return:
+    :raise KeyError: Unknown index name.
+    """
+    drop_names = {get_index(name).name for name in names} if names is not None \
+        else {index.name for index in indices | set(optional_indices.values())} | replaced_index_names
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        for name in sorted(drop_names):
+            connection.execute(_get_drop_index_sql(name, concurrently))
+
+
+def _get_index_validity(connection, index: Index):
+    """
+    Check whether an index exists in the database and is valid (an interrupted concurrent build leaves an invalid
+    index, which isn't used by queries).
+    :param connection: Database connection
+    :param index: Index to check
+    :return: True if the index is valid, False if it's invalid, None if it doesn't exist.
     """
-    for index in indices:
-        index.drop(bind=db.engine)
+    return connection.execute(text("SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(:name)"),
+                              name=index.name).scalar()
+
+
+def _get_create_index_sql(index: Index, concurrently: bool) -> str:
+    """ Return CREATE INDEX [CONCURRENTLY] IF NOT EXISTS statement for an index. """
+    sql = str(CreateIndex(index).compile(dialect=db.engine.dialect))
+    return sql.replace('CREATE INDEX ', 'CREATE INDEX {}IF NOT EXISTS '.format('CONCURRENTLY ' if concurrently else ''),
+                       1)
+
+
+def _get_drop_index_sql(name: str, concurrently: bool) -> str:
+    """ Return DROP INDEX [CONCURRENTLY] IF EXISTS statement for an index, by name. """
+    return 'DROP INDEX {}IF EXISTS {}'.format('CONCURRENTLY ' if concurrently else '',
+                                              db.engine.dialect.identifier_preparer.quote(name))
@@ -7,18 +7,32 @@ directly along with SQLAlchemy methods (e.g. and_/or_ to generate queries; sessi
 Project: QuasselFlask
 """
 
+import hashlib
+import itertools
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+
 import sqlalchemy.orm
-from sqlalchemy import desc, asc, and_, or_, func
+from sqlalchemy.ext import baked
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy import desc, asc, and_, or_, func, tuple_, literal_column, true, any_, bindparam, select, union_all, \
+    ARRAY, Integer, BigInteger
 
-from quasselflask.models.models import QfPermission
+from quasselflask import app
+from quasselflask.models.models import QfPermission, fulltext_config
 from quasselflask.models.models import QuasselUser, Network, Backlog, Buffer, Sender, QfUser
 from quasselflask.models.types import PermissionAccess as Access, PermissionType as Type
-from quasselflask.parsing.form import convert_glob_to_like, escape_like
+from quasselflask.parsing.form import convert_glob_to_like_substring, escape_like
 from quasselflask.parsing.irclog import BufferType
-from quasselflask.parsing.query import BooleanQuery
+from quasselflask.parsing.query import BooleanQuery, Operator
+from quasselflask.util import LruCache
 
 
-def build_query_backlog(session, args, query_options=tuple()) -> sqlalchemy.orm.Query:
+def build_query_backlog(session, args, query_options=tuple(), entities=(Backlog,)) -> sqlalchemy.orm.Query:
     """
     Builds database query (as an SQLAlchemy Query object) for an IRC backlog search, given various search parameters.
     This function does very little checking on the structure of ``args``, as it assumes the args have already been
@@ -26,26 +40,482 @@ def build_query_backlog(session, args, query_options=tuple()) -> sqlalchemy.orm.
 
     :param session: Database session (SQLAlchemy)
     :param args: Search parameters as returned by quasselflask.parsing.form.process_search_params(). Refer to that
-        function for structure information.
+        function for structure information. Additionally requires the 'bufferids' and 'senderids' keys, as returned by
+        ``resolve_search_bufferids()`` and ``resolve_search_senderids()``, and uses the optional 'messageid_range' key
+        as returned by ``resolve_search_messageid_range()``.
     :param query_options: iterable of options passed to Query.options()
+    :param entities: Entities or columns to query. Defaults to Backlog objects; see also ``backlog_row_columns``.
     :return:
     """
-    # prepare SQL query joins
-    query = session.query(Backlog).join(Buffer).join(Sender)  # type: sqlalchemy.orm.query.Query
+    # All values are passed as named bound parameters. The structure of the query only depends on which parameters are
+    # present and on _get_backlog_query_shape(), so that it can be cached by build_query_backlog_baked().
+    params = _get_backlog_query_params(args)
+
+    if _is_plan_lateral(args, params, query_options):
+        return _build_query_backlog_lateral(session, args, params, entities)
+
+    # prepare SQL query joins: only needed if the buffers/senders weren't pre-resolved to IDs
+    query = session.query(*entities)  # type: sqlalchemy.orm.query.Query
+    if 'bufferids' not in params:
+        query = query.join(Buffer)
+    if 'usermask_0' in params:
+        query = query.join(Sender)
     if query_options:
         query = query.options(*query_options)
-    query = _apply_backlog_search_filter(query, args)
+    query = _apply_backlog_search_filter(query, args, params)
+
+    order = desc if is_order_descending(args) else asc
+    query = query.order_by(*(order(column) for column in _get_backlog_sort_key(args)))
+    query = query.limit(bindparam('limit', params['limit']))
 
-    if args.get('order') == 'newest':
-        query = query.order_by(desc(Backlog.time))
+    return query
+
+
+def _get_backlog_sort_key(args: dict) -> tuple:
+    """
+    Return the columns that backlog search results are sorted by: time, with messageid to break ties between records
+    with the same time so that the sort key is unique for keyset pagination. Searches filtered by a messageid range
+    (see ``resolve_search_messageid_range()``) are sorted by messageid alone, which is the same order.
+    """
+    return (Backlog.messageid,) if is_search_messageid_range(args) else (Backlog.time, Backlog.messageid)
+
+
+def _is_plan_lateral(args: dict, params: dict, query_options=tuple()) -> bool:
+    """ Check whether a backlog search query uses the per-buffer plan (see ``choose_backlog_plan()``). """
+    return args.get('plan') == 'lateral' and 'bufferids' in params and params['limit'] is not None \
+        and not query_options
+
+
+def _build_query_backlog_lateral(session, args: dict, params: dict, entities) -> sqlalchemy.orm.Query:
+    """
+    Build the per-buffer plan of ``build_query_backlog()``: for each searched buffer, a LATERAL subquery selects the
+    first ``limit`` matching records of that buffer in query order (a bounded scan of the (bufferid, time, messageid)
+    or (bufferid, messageid) index), and the merged records are sorted again and limited.
+
+    Query options aren't supported, as the entities are selected from the subquery.
+    """
+    searched_buffer = select([func.unnest(bindparam('bufferids', params['bufferids'], type_=ARRAY(Integer)))
+                             .label('bufferid')]).alias('searched_buffer')
+
+    # only select the columns needed, so that the subquery can be an index-only scan for ``backlog_key_columns``
+    if any(entity is Backlog for entity in entities):
+        columns = [Backlog]
     else:
-        query = query.order_by(asc(Backlog.time))
+        keys = {entity.key for entity in entities}
+        columns = list(entities) + [column for column in (Backlog.time, Backlog.messageid) if column.key not in keys]
+
+    query = session.query(*columns).filter(Backlog.bufferid == searched_buffer.c.bufferid)
+    if 'usermask_0' in params:
+        query = query.join(Sender)
+    query = _apply_backlog_search_filter(query, args, params, filter_buffers=False)
 
-    query = query.limit(args.get('limit'))
+    order = desc if is_order_descending(args) else asc
+    sort_key = _get_backlog_sort_key(args)
+    buffer_top = query.order_by(*(order(column) for column in sort_key))\
+        .limit(bindparam('limit', params['limit']))\
+        .subquery()\
+        .lateral('buffer_top')
+    backlog_top = sqlalchemy.orm.aliased(Backlog, buffer_top)
 
+    query = session.query(*(backlog_top if entity is Backlog else buffer_top.c[entity.key] for entity in entities))\
+        .select_from(searched_buffer)\
+        .join(buffer_top, true())\
+        .order_by(*(order(buffer_top.c[column.key]) for column in sort_key))\
+        .limit(bindparam('limit', params['limit']))
     return query
 
 
+_backlog_bakery = baked.bakery(size=256)
+
+# Columns needed to display backlog search results. Querying these instead of Backlog objects avoids the overhead of
+# ORM instances for large result sets; buffer and sender names come from get_buffer_names() and get_senders().
+backlog_row_columns = (Backlog.messageid, Backlog.time, Backlog.type, Backlog.message, Backlog.bufferid,
+                       Backlog.senderid)
+
+# Columns needed to paginate backlog search results, without the message text. See ``stream_backlog_by_messageids()``.
+backlog_key_columns = (Backlog.messageid, Backlog.time, Backlog.bufferid, Backlog.senderid)
+
+
+def build_query_backlog_baked(session, args, query_options=tuple(), entities=(Backlog,)) -> baked.Result:
+    """
+    Cached-statement version of ``build_query_backlog()``. The query is built and compiled to SQL once per query shape
+    (which filters are present, the structure of the search query, order, etc.), and only the parameter values are
+    bound for each search.
+
+    :param session: Database session (SQLAlchemy)
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :param query_options: iterable of options passed to Query.options(). This is part of the cache key: pass the same
+        option objects on every call (e.g. module-level constants), or the statement won't be reused.
+    :param entities: Entities or columns to query, as for ``build_query_backlog()``. Also part of the cache key.
+    :return: Baked query result: call ``.all()``, iterate, etc.
+    """
+    if isinstance(session, sqlalchemy.orm.scoped_session):
+        session = session()  # baked queries need the actual session
+    params = _get_backlog_query_params(args)
+    baked_query = _backlog_bakery(lambda s: build_query_backlog(s, args, query_options, entities),
+                                  _get_backlog_query_shape(args, params), tuple(query_options), tuple(entities))
+    return baked_query(session).params(**params)
+
+
+def _get_backlog_query_params(args: dict) -> dict:
+    """
+    Return the values of the bound parameters of a backlog search query, by name. Which parameters are present
+    determines the filters in the query.
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :return: dict
+    """
+    params = {'limit': args['limit']}
+    start_messageid, end_messageid = args.get('messageid_range') or (None, None)
+    if start_messageid is not None:
+        params['start_messageid'] = start_messageid
+    elif args.get('start'):
+        params['start'] = args['start']
+    if end_messageid is not None:
+        params['end_messageid'] = end_messageid
+    elif args.get('end'):
+        params['end'] = args['end']
+    window_start, window_end = args.get('window') or (None, None)
+    if window_start:
+        params['window_start'] = window_start
+    if window_end:
+        params['window_end'] = window_end
+    if args.get('cursor') and is_search_messageid_range(args):
+        params['cursor_messageid'] = args['cursor'][1]
+    elif args.get('cursor'):
+        params['cursor_time'], params['cursor_messageid'] = args['cursor']
+    if args['bufferids'] is not None:
+        params['bufferids'] = sorted(args['bufferids'])
+    if args['senderids'] is not None and len(args['senderids']) == 1:
+        params['senderid'], = args['senderids']  # can use the (senderid, time) index in time order
+    elif args['senderids'] is not None:
+        params['senderids'] = sorted(args['senderids'])
+    elif args.get('usermasks'):
+        params.update(('usermask_{:d}'.format(i), usermask) for i, usermask in enumerate(args['usermasks']))
+    if args.get('types') is not None:
+        params['types'] = sorted(backlog_type.value for backlog_type in args['types'])
+    for i, (kind, value) in enumerate(_get_search_terms(args)):
+        if value is not None:
+            params['term_{:d}'.format(i)] = value
+    return params
+
+
+def _get_backlog_query_shape(args: dict, params: dict) -> tuple:
+    """
+    Return a hashable key identifying the structure of a backlog search query, i.e. everything except parameter values.
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :param params: Parameters, as returned by ``_get_backlog_query_params(args)``.
+    :return:
+    """
+    query = args.get('query')
+    terms = iter(_get_search_terms(args))
+    query_shape = tuple(token if isinstance(token, Operator) else next(terms)[0] for token in query.get_parsed()) \
+        if query is not None else ()
+    return (frozenset(params), args.get('cursor_direction') if args.get('cursor') else None,
+            is_order_descending(args), bool(args.get('query_wildcard')), bool(args.get('query_fulltext')), query_shape,
+            args.get('plan'))
+
+
+def search_backlog(session, args, query_options=tuple(), windows: [timedelta]=None, entities=(Backlog,)) -> list:
+    """
+    Execute an IRC backlog search, returning results in query order (see ``is_order_descending()``).
+
+    If ``windows`` is given, newest-first searches scan backwards in time windows of increasing size, and stop as soon
+    as ``limit`` results are found. For rare search terms, this avoids walking the whole backlog time index in a single
+    ``ORDER BY time DESC LIMIT n`` query. Oldest-first searches, searches using the per-buffer plan (see
+    ``choose_backlog_plan()``) and searches bounded by a messageid range (see ``resolve_search_messageid_range()``)
+    always use a single query.
+
+    :param session: Database session (SQLAlchemy)
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :param query_options: iterable of options passed to Query.options()
+    :param windows: Time spans from the newest searchable time, in increasing order (e.g. 1 day, 7 days, 30 days).
+        Each window searches the part of the backlog not searched by the previous window; after the last window, the
+        rest of the backlog is searched. If None or empty, searches in a single query.
+    :param entities: Entities or columns to query, as for ``build_query_backlog()``.
+    :return: List of Backlog objects (or rows of ``entities``)
+    """
+    if not _is_search_windowed(args, windows):
+        return build_query_backlog_baked(session, args, query_options, entities).all()
+
+    results = []
+    for i, (window_start, window_end) in enumerate(_iter_search_windows(session, args, windows)):
+        window_args = dict(args, limit=args['limit'] - len(results), window=(window_start, window_end))
+        time_start = time.perf_counter()
+        window_results = build_query_backlog_baked(session, window_args, query_options, entities).all()
+        app.logger.debug("Search window %i (%s, %s]: %i results in %.3fs", i,
+                         window_start.isoformat() if window_start else '', window_end.isoformat(),
+                         len(window_results), time.perf_counter() - time_start)
+
+        results.extend(window_results)
+        if len(results) >= args['limit']:
+            break
+    return results
+
+
+def _is_search_windowed(args: dict, windows: [timedelta]) -> bool:
+    """ Check whether ``search_backlog()`` searches in time windows. """
+    return bool(windows) and is_order_descending(args) and args.get('plan') != 'lateral' \
+        and not is_search_messageid_range(args)
+
+
+def _iter_search_windows(session, args: dict, windows: [timedelta]):
+    """
+    Generate the time windows of a search, newest first (see ``search_backlog()``).
+    :param session: Database session (SQLAlchemy)
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :param windows: Time spans from the newest searchable time, in increasing order.
+    :return: Generator of (window start or None for the last window, window end). Generates nothing if the backlog is
+        empty.
+    """
+    # searchable time range: bounded by the oldest and newest backlog records (both found via the time index)
+    lower, upper = session.query(func.min(Backlog.time), func.max(Backlog.time)).one()
+    if upper is None:
+        return
+    if args.get('start'):
+        lower = max(lower, args['start'])
+    if args.get('end'):
+        upper = min(upper, args['end'])
+    if args.get('cursor'):
+        upper = min(upper, args['cursor'][0])
+
+    window_end = upper
+    for span in list(windows) + [None]:
+        window_start = upper - span if span is not None else None
+        if window_start is not None and window_start < lower:
+            window_start = None  # last window: nothing older to search
+        yield window_start, window_end
+        if window_start is None:
+            return
+        window_end = window_start
+
+
+def _weigh_search_results(key, value) -> int:
+    """ Approximate memory use of a search results cache entry. """
+    return sys.getsizeof(value[1]) + sys.getsizeof(key) + 512
+
+
+_search_results_cache = LruCache(max_size=4096, max_weight=app.config.get('QF_RESULT_CACHE_MAX_BYTES', 32*1024*1024),
+                                 weigher=_weigh_search_results)
+
+
+def search_backlog_cached(session, args, query_options=tuple(), windows: [timedelta]=None, ttl: float=60,
+                          entities=(Backlog,)) -> list:
+    """
+    Cached version of ``search_backlog()``. Only the messageids of the results are cached; on a cache hit, the records
+    are loaded by messageid. Entries are shared between searches that differ only by ``limit``.
+
+    Results of searches that end in the past (``end`` or a newest-first page cursor before the current time) can't
+    change, and are kept until evicted. Other results are cached for ``ttl`` seconds, so that new messages show up.
+
+    :param session: Database session (SQLAlchemy)
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :param query_options: iterable of options passed to Query.options()
+    :param windows: As for ``search_backlog()``.
+    :param ttl: Time-to-live of cached results that may still change, in seconds.
+    :param entities: Entities or columns to query, as for ``build_query_backlog()``. Must include Backlog.messageid.
+    :return: List of Backlog objects (or rows of ``entities``), in query order
+    """
+    if not _search_results_cache.max_weight:
+        return search_backlog(session, args, query_options, windows, entities)
+
+    key = _get_search_cache_key(args)
+    cached = _search_results_cache.get(key)  # (limit, messageids)
+    if cached is not None:
+        cached_limit, messageids = cached
+        # usable if it has enough results, or if it has all the results
+        if len(messageids) >= args['limit'] or len(messageids) < cached_limit:
+            return query_backlog_by_messageids(session, messageids[:args['limit']], query_options, entities)
+
+    results = search_backlog(session, args, query_options, windows, entities)
+    _search_results_cache.set(key, (args['limit'], array('q', (record.messageid for record in results))),
+                              ttl=None if _is_search_past(args) else ttl)
+    return results
+
+
+def query_backlog_by_messageids(session, messageids: [int], query_options=tuple(), entities=(Backlog,)) -> list:
+    """
+    Load backlog records by messageid.
+    :param session: Database session (SQLAlchemy)
+    :param messageids: Sequence of messageids
+    :param query_options: iterable of options passed to Query.options()
+    :param entities: Entities or columns to query, as for ``build_query_backlog()``. Must include Backlog.messageid.
+    :return: List of Backlog objects (or rows of ``entities``), in the same order as ``messageids``. Records not found
+        are omitted.
+    """
+    if not messageids:
+        return []
+    if isinstance(session, sqlalchemy.orm.scoped_session):
+        session = session()  # baked queries need the actual session
+    baked_query = _backlog_bakery(lambda s: s.query(*entities), tuple(query_options), tuple(entities))
+    if query_options:
+        baked_query += lambda q: q.options(*query_options)
+    baked_query += lambda q: q.filter(Backlog.messageid == any_(bindparam('messageids', type_=ARRAY(BigInteger))))
+    records = {record.messageid: record for record in baked_query(session).params(messageids=list(messageids))}
+    return [records[messageid] for messageid in messageids if messageid in records]
+
+
+def stream_backlog_by_messageids(session, messageids: [int], entities=(Backlog,), batch_size=500):
+    """
+    Load backlog records by messageid in chronological order, lazily. Records are fetched from a server-side cursor in
+    batches of ``batch_size``, so that only one batch is held in memory at a time.
+    :param session: Database session (SQLAlchemy)
+    :param messageids: Sequence of messageids
+    :param entities: Entities or columns to query, as for ``build_query_backlog()``.
+    :param batch_size: Number of records fetched from the database at a time.
+    :return: Iterable of Backlog objects (or rows of ``entities``), ordered by time and messageid. Records not found are
+        omitted.
+    """
+    if not messageids:
+        return iter(())
+    return session.query(*entities)\
+        .filter(Backlog.messageid == any_(bindparam('messageids', list(messageids), type_=ARRAY(BigInteger))))\
+        .order_by(asc(Backlog.time), asc(Backlog.messageid))\
+        .yield_per(batch_size)
+
+
+def query_message_buffer(session, messageid: int):
+    """
+    Look up the buffer of a backlog message.
+    :param session: Database session (SQLAlchemy)
+    :param messageid: Message ID
+    :return: Row of (bufferid, buffertype), or None if the message doesn't exist.
+    """
+    return session.query(Backlog.bufferid, Buffer.buffertype)\
+        .join(Buffer, Buffer.bufferid == Backlog.bufferid)\
+        .filter(Backlog.messageid == messageid)\
+        .one_or_none()
+
+
+def query_backlog_context(session, bufferid: int, messageid: int, num_before: int, num_after: int,
+                          entities=(Backlog,)) -> list:
+    """
+    Load the context of a backlog message: the message itself, and the messages immediately before and after it in the
+    same buffer. Each side is a single bounded seek on the (bufferid, messageid) index, so the cost doesn't depend on
+    the size of the buffer.
+    :param session: Database session (SQLAlchemy)
+    :param bufferid: Buffer of the message (see ``query_message_buffer()``)
+    :param messageid: Message ID
+    :param num_before: Maximum number of messages before the message
+    :param num_after: Maximum number of messages after the message
+    :param entities: Entities or columns to query, as for ``build_query_backlog()``.
+    :return: List of Backlog objects (or rows of ``entities``), in messageid order
+    """
+    query = session.query(*entities).filter(Backlog.bufferid == bufferid)
+    before = query.filter(Backlog.messageid < messageid).order_by(desc(Backlog.messageid)).limit(num_before).all()
+    after = query.filter(Backlog.messageid >= messageid).order_by(asc(Backlog.messageid)).limit(num_after + 1).all()
+    return before[::-1] + after
+
+
+def _build_query_backlog_contexts():
+    """
+    Build the statement for ``query_backlog_contexts()``: for each (messageid, bufferid) pair in the ``hit_messageids``
+    and ``hit_bufferids`` array parameters, a LATERAL join selects up to ``num_before`` messages before it and
+    ``num_after`` messages from it onwards in the same buffer. Each side is a bounded seek on the (bufferid, messageid)
+    index.
+    """
+    hit = select([func.unnest(bindparam('hit_messageids', type_=ARRAY(BigInteger))).label('messageid'),
+                  func.unnest(bindparam('hit_bufferids', type_=ARRAY(Integer))).label('bufferid')]).alias('hit')
+    before = select(backlog_row_columns)\
+        .where(and_(Backlog.bufferid == hit.c.bufferid, Backlog.messageid < hit.c.messageid))\
+        .order_by(desc(Backlog.messageid))\
+        .limit(bindparam('num_before'))
+    after = select(backlog_row_columns)\
+        .where(and_(Backlog.bufferid == hit.c.bufferid, Backlog.messageid >= hit.c.messageid))\
+        .order_by(asc(Backlog.messageid))\
+        .limit(bindparam('num_after'))
+    context = union_all(before, after).lateral('context')
+    return select(list(context.c) + [hit.c.messageid.label('hit_messageid')]).select_from(hit.join(context, true()))
+
+
+_query_backlog_contexts = _build_query_backlog_contexts()
+
+
+def query_backlog_contexts(session, hits, num_context: int) -> [list]:
+    """
+    Load the context of many backlog messages (e.g. a page of search results) in a single query, like ``grep -C``.
+    Contexts in the same buffer that overlap or touch (no message of the buffer between them) are merged, so that each
+    message is in at most one context.
+    :param session: Database session (SQLAlchemy)
+    :param hits: Sequence of Backlog objects or rows with messageid and bufferid, e.g. search results
+    :param num_context: Number of messages before and after each hit
+    :return: List of contexts, ordered by their first hit in ``hits``. Each context is a list of rows of
+        ``backlog_row_columns`` in messageid order, including the hits.
+    """
+    if not hits:
+        return []
+    hit_bufferids = {hit.messageid: hit.bufferid for hit in hits}
+    rows_by_hit = {}
+    # one more message than needed before each hit: if it's in the previous context, the contexts touch
+    params = {'hit_messageids': list(hit_bufferids), 'hit_bufferids': list(hit_bufferids.values()),
+              'num_before': num_context + 1, 'num_after': num_context + 1}
+    for row in session.execute(_query_backlog_contexts, params):
+        rows_by_hit.setdefault(row.hit_messageid, []).append(row)
+
+    contexts = []  # (index of first hit, context)
+    buffer_contexts = {}  # bufferid: last context in that buffer
+    first_hits = {}  # messageid: index of its first occurrence in hits
+    for i, hit in enumerate(hits):
+        first_hits.setdefault(hit.messageid, i)
+    for messageid, i in sorted(first_hits.items(), key=lambda item: (hit_bufferids[item[0]], item[0])):
+        rows = sorted(rows_by_hit.get(messageid, ()), key=lambda row: row.messageid)
+        if not rows:
+            continue
+        context = buffer_contexts.get(hit_bufferids[messageid])
+        if context and rows[0].messageid <= context[-1].messageid:  # overlaps or touches: merge
+            last_messageid = context[-1].messageid
+            context.extend(row for row in rows if row.messageid > last_messageid)
+        else:
+            if sum(row.messageid < messageid for row in rows) > num_context:
+                rows = rows[1:]  # the extra message before the hit isn't part of its context
+            buffer_contexts[hit_bufferids[messageid]] = rows
+            contexts.append((i, rows))
+    return [context for _, context in sorted(contexts, key=lambda item: item[0])]
+
+
+def _get_search_cache_key(args: dict) -> tuple:
+    """
+    Return a key identifying the results of a search, except for the limit. Buffers and senders are identified by their
+    resolved IDs (so users with different permissions never share results), hashed to keep keys small.
+    """
+    def hash_ids(ids):
+        return hashlib.sha1(array('q', sorted(ids)).tobytes()).digest() if ids is not None else None
+
+    return (tuple(args['query'].get_parsed()), bool(args.get('query_wildcard')), bool(args.get('query_fulltext')),
+            args.get('start'), args.get('end'), args.get('cursor'), args.get('cursor_direction'),
+            is_order_descending(args), hash_ids(args['bufferids']), hash_ids(args['senderids']),
+            tuple(sorted(args['usermasks'])) if args['senderids'] is None else None,
+            frozenset(args['types']) if args.get('types') is not None else None)
+
+
+def _is_search_past(args: dict) -> bool:
+    """
+    Check whether a search only covers backlog older than the current time, so its results can't change. Compares
+    against both local time and UTC, to be safe regardless of the timezone that Quassel stores times in.
+    """
+    if args.get('cursor') and args.get('cursor_direction') == 'before':
+        upper = args['cursor'][0]
+        if args.get('end'):
+            upper = min(upper, args['end'])
+    else:
+        upper = args.get('end')
+    return upper is not None and upper < min(datetime.now(), datetime.utcnow())
+
+
+def is_order_descending(args: dict) -> bool:
+    """
+    Check whether a backlog search retrieves records in descending (newest-first) order. This is determined by the
+    page cursor direction if a cursor is set, or else by the requested order.
+
+    Results of a descending query must be reversed for chronological display.
+
+    :param args: Search parameters as returned by quasselflask.parsing.form.process_search_params().
+    :return:
+    """
+    if args.get('cursor'):
+        return args.get('cursor_direction') == 'before'
+    return args.get('order') == 'newest'
+
+
 def build_query_usermask(session, args) -> sqlalchemy.orm.Query:
     """
     Builds database query (as an SQLAlchemy Query object) for an IRC usermask search, given various search parameters
@@ -66,40 +536,343 @@ def build_query_usermask(session, args) -> sqlalchemy.orm.Query:
     return query
 
 
-def _apply_backlog_search_filter(query: sqlalchemy.orm.Query, args: dict) -> sqlalchemy.orm.Query:
+def _apply_backlog_search_filter(query: sqlalchemy.orm.Query, args: dict, params: dict, filter_buffers: bool=True)\
+        -> sqlalchemy.orm.Query:
     """
-    Applies the filter criteria from ``args`` (Backlog start/end time, Backlog message text search, Buffer name,
-    current user Buffer permissions) onto an existing query ``query``.
+    Applies the filter criteria from ``args`` (Backlog start/end time, Backlog message text search, Backlog message
+    types, Sender usermask, searched bufferids as resolved from channel names and permissions) onto an existing query
+    ``query``.
 
     See ``build_query_backlog()`` for example usage.
 
     :param query:
     :param args:
+    :param params: Bound parameter values, as returned by ``_get_backlog_query_params(args)``.
+    :param filter_buffers: Whether to filter by bufferids. If False, the caller must restrict the buffers searched.
     :return:
     """
-    if args.get('start'):
-        query = query.filter(Backlog.time >= args.get('start'))
+    def param(name, **kwargs):
+        return bindparam(name, params[name], **kwargs)
 
-    if args.get('end'):
-        query = query.filter(Backlog.time <= args.get('end'))
+    # time bounds, or the equivalent messageid range (see resolve_search_messageid_range())
+    if 'start_messageid' in params:
+        query = query.filter(Backlog.messageid >= param('start_messageid'))
+    elif 'start' in params:
+        query = query.filter(Backlog.time >= param('start'))
+
+    if 'end_messageid' in params:
+        query = query.filter(Backlog.messageid <= param('end_messageid'))
+    elif 'end' in params:
+        query = query.filter(Backlog.time <= param('end'))
+
+    # time window (start exclusive, end inclusive), used by search_backlog()
+    if 'window_start' in params:
+        query = query.filter(Backlog.time > param('window_start'))
+    if 'window_end' in params:
+        query = query.filter(Backlog.time <= param('window_end'))
+
+    # keyset pagination: seek past the page boundary record, in the cursor direction (see _get_backlog_sort_key())
+    if 'cursor_messageid' in params:
+        if 'cursor_time' in params:
+            sort_key, cursor = tuple_(Backlog.time, Backlog.messageid), \
+                tuple_(param('cursor_time'), param('cursor_messageid'))
+        else:
+            sort_key, cursor = Backlog.messageid, param('cursor_messageid')
+        if args.get('cursor_direction') == 'before':
+            query = query.filter(sort_key < cursor)
+        else:
+            query = query.filter(sort_key > cursor)
+
+    # Usermasks, pre-resolved to senderids if there aren't too many matches
+    if 'senderid' in params:
+        query = query.filter(Backlog.senderid == param('senderid'))
+    elif 'senderids' in params:
+        query = query.filter(Backlog.senderid == any_(param('senderids', type_=ARRAY(Integer))))
+    elif 'usermask_0' in params:
+        query = query.filter(or_(*(Sender.sender.ilike(param('usermask_{:d}'.format(i)))
+                                   for i in range(len(args['usermasks'])))))
 
-    # Flat-list arguments
-    for channel in args.get('channels'):
-        query = query.filter(Buffer.buffername.ilike(channel))
-    for usermask in args.get('usermasks'):
-        query = query.filter(Sender.sender.ilike(usermask))
+    # Message types. The values are sent as a literal array, so the planner can use the partial indices on conversation
+    # types (see models.indices) when the searched types are a subset of them.
+    if 'types' in params:
+        query = query.filter(Backlog.type == any_(param('types', type_=ARRAY(Integer))))
 
     # fulltext string
-    query_message_filter = build_filter_backlog_fulltext(args.get('query'), args.get('query_wildcard', None))
+    query_message_filter = build_filter_backlog_fulltext(args.get('query'), args.get('query_wildcard', None),
+                                                         args.get('query_fulltext', False))
     if query_message_filter is not None:
         query = query.filter(query_message_filter)
 
-    query = query.filter(Buffer.bufferid.in_(pbuf.bufferid for pbuf in args['permissions']))
+    # Channels and permissions, pre-resolved to bufferids: None means all channel buffers. Otherwise, pass the bufferids
+    # as a single array parameter, so that the statement text doesn't grow with the number of buffers.
+    if filter_buffers:
+        if 'bufferids' in params:
+            query = query.filter(Backlog.bufferid == any_(param('bufferids', type_=ARRAY(Integer))))
+        else:
+            query = query.filter(Buffer.buffertype == BufferType.channel_buffer.value)
 
     return query
 
 
-def build_filter_backlog_fulltext(query: BooleanQuery, query_wildcard: bool) -> (sqlalchemy.orm.Query, [str]):
+def resolve_search_bufferids(session: sqlalchemy.orm.Session, args: dict) -> frozenset:
+    """
+    Resolve the channel globs and permitted buffers of a search to the set of bufferids to search. Channel globs are
+    matched against the (small) buffer table, rather than per backlog row.
+
+    :param session: Database session to use
+    :param args: Search parameters as returned by quasselflask.parsing.form.process_search_params(), plus the
+        'permissions' key (set of permitted bufferids, or None if unrestricted).
+    :return: frozenset of bufferids, or None if all channel buffers are searched. If empty, the search has no results.
+    """
+    if not args.get('channels'):
+        return args['permissions']
+
+    bufferids = frozenset(query_channel_bufferids(session, args['channels']))
+    if args['permissions'] is not None:
+        bufferids = bufferids.intersection(args['permissions'])
+    return bufferids
+
+
+def resolve_search_messageid_range(session: sqlalchemy.orm.Session, args: dict) -> (int, int):
+    """
+    Translate the start and end times of a search into the range of messageids of the records between them. Each bound
+    is found by two lookups in the time index. Searches with a messageid range are filtered and sorted by messageid
+    (primary key) instead of time: the range then combines with other indices (e.g. to only read the part of a
+    full-text index match within the range), and with the primary key or the (bufferid, messageid) index to read
+    records in order.
+
+    Quassel assigns increasing messageids as it stores messages, so this assumes that messages are stored in time order.
+    If they aren't (e.g. imported or merged backlog), time-bounded searches may miss records or return them out of time
+    order: this is why QF_MESSAGEID_TIME_RANGE is disabled by default.
+
+    :param session: Database session to use
+    :param args: Search parameters as returned by quasselflask.parsing.form.process_search_params().
+    :return: (first messageid, last messageid). Either is None if the search has no such time bound. If no record is
+        within the time bounds, the range is empty (first messageid greater than last), see ``is_search_empty()``.
+    """
+    start_messageid = end_messageid = None
+    if args.get('start'):
+        start_time = session.query(func.min(Backlog.time)).filter(Backlog.time >= args['start']).as_scalar()
+        start_messageid = session.query(func.min(Backlog.messageid)).filter(Backlog.time == start_time).scalar()
+        if start_messageid is None:  # no record after start
+            return 1, 0
+    if args.get('end'):
+        end_time = session.query(func.max(Backlog.time)).filter(Backlog.time <= args['end']).as_scalar()
+        end_messageid = session.query(func.max(Backlog.messageid)).filter(Backlog.time == end_time).scalar()
+        if end_messageid is None:  # no record before end
+            return 1, 0
+    return start_messageid, end_messageid
+
+
+def is_search_messageid_range(args: dict) -> bool:
+    """
+    Check whether a backlog search is bounded by a messageid range rather than by time (see
+    ``resolve_search_messageid_range()``).
+    """
+    return any(messageid is not None for messageid in args.get('messageid_range') or ())
+
+
+_usermask_senderids_cache = LruCache(max_size=256)
+
+
+def resolve_search_senderids(session: sqlalchemy.orm.Session, args: dict, max_senderids: int=5000, ttl: float=300)\
+        -> frozenset:
+    """
+    Resolve the usermask globs of a search to the set of matching senderids, so that the backlog can be filtered by
+    senderid without joining the sender table. Results are cached per set of usermasks for ``ttl`` seconds: senders
+    first seen after a usermask was cached aren't found until the cache entry expires.
+
+    :param session: Database session to use
+    :param args: Search parameters as returned by quasselflask.parsing.form.process_search_params().
+    :param max_senderids: Maximum number of matching senders. If more senders match, returns None and the search
+        matches usermasks against the sender table instead.
+    :param ttl: Cache time-to-live, in seconds.
+    :return: frozenset of senderids, or None if there are no usermasks or too many matching senders. If empty, the
+        search has no results.
+    """
+    if not args.get('usermasks'):
+        return None
+
+    key = (tuple(sorted(set(args['usermasks']))), max_senderids)
+    cached = _usermask_senderids_cache.get(key)  # 1-tuple, as None is a valid result
+    if cached is None:
+        cached = (query_usermask_senderids(session, args['usermasks'], max_senderids),)
+        _usermask_senderids_cache.set(key, cached, ttl=ttl)
+    return cached[0]
+
+
+def query_usermask_senderids(session: sqlalchemy.orm.Session, usermasks: [str], max_senderids: int=None) \
+        -> frozenset:
+    """
+    Find the senders matching any of the given patterns.
+    :param session: Database session to use
+    :param usermasks: List of SQL LIKE patterns (matched case-insensitively)
+    :param max_senderids: Maximum number of senders to return. None for no limit.
+    :return: frozenset of senderids, or None if more than ``max_senderids`` senders match.
+    """
+    query = session.query(Sender.senderid).filter(or_(*(Sender.sender.ilike(usermask) for usermask in usermasks)))
+    if max_senderids is not None:
+        query = query.limit(max_senderids + 1)
+    senderids = frozenset(senderid for senderid, in query)
+    if max_senderids is not None and len(senderids) > max_senderids:
+        return None
+    return senderids
+
+
+def is_search_empty(args: dict) -> bool:
+    """
+    Check whether a search is known to have no results without querying the backlog, i.e. no buffer is both permitted
+    and matched by the channel search parameter, no sender matches the usermask search parameter, or no record is
+    within the start and end times.
+    :param args: Search parameters, including 'bufferids' and 'senderids' as returned by ``resolve_search_bufferids()``
+        and ``resolve_search_senderids()``, and optionally 'messageid_range' as returned by
+        ``resolve_search_messageid_range()``.
+    :return:
+    """
+    start_messageid, end_messageid = args.get('messageid_range') or (None, None)
+    return (args['bufferids'] is not None and not args['bufferids']) or \
+        (args['senderids'] is not None and not args['senderids']) or \
+        (start_messageid is not None and end_messageid is not None and start_messageid > end_messageid)
+
+
+def choose_backlog_plan(session: sqlalchemy.orm.Session, args: dict, stats_ttl: float=3600, seek_cost: float=10,
+                        heap_cost: float=4) -> str:
+    """
+    Choose how a backlog search is executed, from the number of searched buffers and their estimated sizes:
+
+    * 'time': a single scan of the backlog in time order (time index), skipping records of other buffers. Efficient
+      when the searched buffers make up a large part of the backlog.
+    * 'lateral': a separate scan of each searched buffer ((bufferid, time, messageid) index), each stopping after
+      ``limit`` records, and a merge of the results. Efficient when searching a few buffers among many, whose records
+      would be few and far between in the time index, or a few large buffers and many small ones.
+
+    Only searches restricted to specific buffers (see ``resolve_search_bufferids()``) and without search terms or
+    usermasks can use the per-buffer plan: the statistics don't predict how many records match those filters.
+
+    :param session: Database session (SQLAlchemy)
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :param stats_ttl: How long to cache buffer size statistics, in seconds. See ``get_backlog_buffer_stats()``.
+    :param seek_cost: Estimated cost of starting the scan of a buffer, relative to the cost of reading one record from
+        an index.
+    :param heap_cost: Estimated cost of reading one record from the backlog table, relative to the cost of reading it
+        from an index.
+    :return: 'time' or 'lateral', to set as ``args['plan']``.
+    """
+    limit = args.get('limit')
+    if not args['bufferids'] or not limit or args['senderids'] is not None or args.get('usermasks') \
+            or _get_search_terms(args):
+        return 'time'
+    stats = get_backlog_buffer_stats(session, stats_ttl)
+    if stats is None:
+        return 'time'
+
+    total_rows, buffer_rows, other_buffer_rows = stats
+    rows = [buffer_rows.get(bufferid, other_buffer_rows) for bufferid in args['bufferids']]
+    searched_rows = sum(rows)
+    if searched_rows <= 0:
+        return 'time'
+    # time plan: walk the time index until ``limit`` records of the searched buffers are found, reading each record from
+    # the table to check its buffer (or, if they are rare, read and sort all their records instead); per-buffer plan:
+    # read up to ``limit`` records of each buffer from the (bufferid, time, messageid, senderid) index
+    time_cost = min(limit * total_rows / searched_rows, searched_rows) * heap_cost
+    lateral_cost = sum(min(limit, num_rows) + seek_cost for num_rows in rows)
+    return 'lateral' if lateral_cost < time_cost else 'time'
+
+
+_backlog_buffer_stats = None  # (stats, time checked)
+_buffer_time_index_name = 'qf_backlog_bufferid_time_messageid_senderid_idx'
+
+
+def get_backlog_buffer_stats(session: sqlalchemy.orm.Session, ttl: float=3600) -> (float, {int: float}, float):
+    """
+    Estimate the number of backlog records of each buffer, from the PostgreSQL planner statistics of the backlog table
+    (``pg_stats``, kept up to date by autovacuum or ANALYZE). This doesn't scan the backlog. Results are cached for
+    ``ttl`` seconds.
+
+    :param session: Database session (SQLAlchemy)
+    :param ttl: Cache time-to-live, in seconds.
+    :return: (estimated number of backlog records, {bufferid: estimated number of records} for the most common buffers,
+        estimated number of records of any other buffer), or None if the backlog hasn't been analyzed yet or the
+        (bufferid, time, messageid) index doesn't exist.
+    """
+    global _backlog_buffer_stats
+    now = time.monotonic()
+    with _cache_lock:
+        if _backlog_buffer_stats is not None and now - _backlog_buffer_stats[1] < ttl:
+            return _backlog_buffer_stats[0]
+
+    row = session.execute(sqlalchemy.text("""
+        SELECT c.reltuples, s.null_frac, s.n_distinct, s.most_common_vals::text AS most_common_vals,
+            s.most_common_freqs, to_regclass(:index_name) IS NOT NULL AS has_index
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stats s ON s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = 'bufferid'
+        WHERE c.oid = to_regclass(:table_name)"""),
+        {'index_name': _buffer_time_index_name, 'table_name': Backlog.__table__.name}).first()
+
+    stats = None
+    if row is not None and row.has_index and row.reltuples > 0 and row.n_distinct is not None:
+        total_rows = row.reltuples
+        num_buffers = row.n_distinct if row.n_distinct >= 0 else -row.n_distinct * total_rows
+        values = [int(value) for value in row.most_common_vals.strip('{}').split(',')] \
+            if row.most_common_vals else []
+        freqs = row.most_common_freqs or []
+        buffer_rows = {bufferid: freq * total_rows for bufferid, freq in zip(values, freqs)}
+        other_freq = max(1 - row.null_frac - sum(freqs), 0)
+        stats = (total_rows, buffer_rows, other_freq * total_rows / max(num_buffers - len(values), 1))
+
+    with _cache_lock:
+        _backlog_buffer_stats = (stats, now)
+    return stats
+
+
+class _Explain(Executable, ClauseElement):
+    """ EXPLAIN statement (PostgreSQL), returning the query plan of ``statement`` as JSON. """
+    def __init__(self, statement, analyze=False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(_Explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON{}) {}'.format(', ANALYZE' if element.analyze else '',
+                                               compiler.process(element.statement, **kwargs))
+
+
+def explain_backlog_search(session: sqlalchemy.orm.Session, args: dict, entities=backlog_key_columns,
+                           analyze: bool=False, windows: [timedelta]=None) -> ([(str, str)], float):
+    """
+    Get the table and index scans that the database uses for the first query of a backlog search
+    (``search_backlog()``), from its query plan (EXPLAIN).
+    :param session: Database session (SQLAlchemy)
+    :param args: Search parameters, as for ``build_query_backlog()``.
+    :param entities: Entities or columns to query, as for ``build_query_backlog()``.
+    :param analyze: Execute the query, to get the actual execution time (EXPLAIN ANALYZE).
+    :param windows: Time windows, as for ``search_backlog()``. If the search uses them, the query of the first window
+        is explained.
+    :return: (list of (scan type, index name or table name) in plan order, e.g. ('Index Only Scan',
+        'qf_backlog_time_idx'); execution time in milliseconds, or None if not ``analyze``)
+    """
+    if _is_search_windowed(args, windows):
+        window = next(_iter_search_windows(session, args, windows), None)
+        if window is not None:
+            args = dict(args, window=window)
+    explain = session.execute(_Explain(build_query_backlog(session, args, entities=entities).statement, analyze))
+    plan = explain.scalar()[0]
+    scans = []
+    nodes = [plan['Plan']]
+    while nodes:
+        node = nodes.pop(0)
+        if 'Index Name' in node:
+            scans.append((node['Node Type'], node['Index Name']))
+        elif node['Node Type'] == 'Seq Scan':
+            scans.append((node['Node Type'], node['Relation Name']))
+        nodes = node.get('Plans', []) + nodes
+    return scans, plan.get('Execution Time')
+
+
+def build_filter_backlog_fulltext(query: BooleanQuery, query_wildcard: bool, query_fulltext: bool=False) \
+        -> (sqlalchemy.orm.Query, [str]):
     """
     Parse a BooleanQuery (parsed boolean search query) and return an SQLAlchemy object that can be passed to filter() or
     expression.select().where().
@@ -111,37 +884,106 @@ def build_filter_backlog_fulltext(query: BooleanQuery, query_wildcard: bool) ->
     :param query_wildcard: If true, search tokens are considered to allow wildcards and a LIKE search is performed
         instead of a keyword search. (Note that a LIKE search doesn't necessarily break on word boundaries, so
         a search of "back" can match "backed" or "aback", even without wildcards.)
+    :param query_fulltext: If true and ``query_wildcard`` is false, a PostgreSQL full-text search is performed instead
+        of a LIKE search, matching whole words only. See ``build_filter_backlog_tsquery()``.
     :return: SQLAlchemy query object that can be used as the argument to a filter() call
     """
+    if query is None:
+        return None
+
+    # If needed, parse the query first
+    if not query.is_tokenized:
+        query.tokenize()
+    if not query.is_parsed:
+        query.parse()
+
+    if query_fulltext and not query_wildcard:
+        return build_filter_backlog_tsquery(query)
+
+    # Search terms are bound as parameters term_0, term_1, ... in order of appearance (see _get_search_terms()).
+    # The LIKE patterns are plain ILIKE conditions on the message column, which the optional trigram index on
+    # backlog.message (qf_backlog_gin_message_idx) can serve; tokens that match anything produce no condition at all.
+    term_numbers = itertools.count()
 
-    # Callback functions for query.eval
-    def wildcard(s: str):
+    def like(s: str):
         if isinstance(s, str):
-            return Backlog.message.ilike('%' + convert_glob_to_like(s)[0] + '%')
+            name = 'term_{:d}'.format(next(term_numbers))
+            kind, value = _get_search_term(s, query_wildcard, False)
+            return Backlog.message.ilike(bindparam(name, value)) if kind == 'like' else true()
         else:
             return s  # can also be a boolean SQL condition object
 
-    def plain(s: str):
+    return query.eval(and_, or_, like)
+
+
+def build_filter_backlog_tsquery(query: BooleanQuery):
+    """
+    Compile a parsed BooleanQuery into a PostgreSQL full-text search condition on the backlog message. AND and OR
+    operators become the tsquery operators & and |; quoted strings of several words become phrase searches (<->).
+
+    The condition matches the ``to_tsvector()`` expression of the ``qf_backlog_gin_message_tsv_idx`` index, so that the
+    search can be served by that index. Search terms are passed as bound parameters to ``plainto_tsquery()`` and
+    ``phraseto_tsquery()``, so no tsquery syntax escaping is needed.
+
+    :param query: Input query. Must already be tokenized and parsed.
+    :return: SQLAlchemy condition that can be used as the argument to a filter() call, or None for an empty query.
+    """
+    config = literal_column("'{}'::regconfig".format(fulltext_config))
+    term_numbers = itertools.count()
+
+    def tsquery(s):
         if isinstance(s, str):
-            return Backlog.message.ilike('%' + escape_like(s) + '%')
+            name = 'term_{:d}'.format(next(term_numbers))
+            kind, value = _get_search_term(s, False, True)
+            if kind == 'phrase':
+                return func.phraseto_tsquery(config, bindparam(name, value))
+            else:
+                return func.plainto_tsquery(config, bindparam(name, value))
         else:
-            return s  # can also be a boolean SQL condition object
+            return s  # already a tsquery SQL expression
 
-    if query is None:
+    def tsquery_and(a, b):
+        return tsquery(a).op('&&')(tsquery(b))
+
+    def tsquery_or(a, b):
+        return tsquery(a).op('||')(tsquery(b))
+
+    sql_tsquery = query.eval(tsquery_and, tsquery_or, tsquery)
+    if sql_tsquery is None:
         return None
+    return func.to_tsvector(config, Backlog.message).op('@@')(sql_tsquery)
 
-    # If needed, parse the query first
+
+def _get_search_terms(args: dict) -> [(str, str)]:
+    """
+    Return the kind and bound parameter value of each search term in the search query, in order of appearance (the
+    order in which ``BooleanQuery.eval()`` processes them). See ``_get_search_term()``.
+    """
+    query = args.get('query')
+    if query is None:
+        return []
     if not query.is_tokenized:
         query.tokenize()
     if not query.is_parsed:
         query.parse()
+    query_wildcard, query_fulltext = bool(args.get('query_wildcard')), bool(args.get('query_fulltext'))
+    return [_get_search_term(token, query_wildcard, query_fulltext)
+            for token in query.get_parsed() if not isinstance(token, Operator)]
+
 
-    # Build the search query
+def _get_search_term(term: str, query_wildcard: bool, query_fulltext: bool) -> (str, str):
+    """
+    Return the kind of condition used for a search term, and the value bound to it.
+    :return: ('like', LIKE pattern), ('any', None) for wildcard patterns that match anything, or ('word', term) or
+        ('phrase', term) for full-text searches.
+    """
     if query_wildcard:
-        sql_query_filter = query.eval(and_, or_, wildcard)
+        pattern = convert_glob_to_like_substring(term)
+        return ('like', pattern) if pattern is not None else ('any', None)
+    elif query_fulltext:
+        return ('phrase' if len(term.split()) > 1 else 'word'), term
     else:
-        sql_query_filter = query.eval(and_, or_, plain)
-    return sql_query_filter
+        return 'like', '%' + escape_like(term) + '%'
 
 
 def query_all_qf_users(session) -> sqlalchemy.orm.query.Query:
@@ -191,6 +1033,19 @@ def query_buffers(session, buffertypes=None) -> sqlalchemy.orm.query.Query:
     return query
 
 
+def query_channel_bufferids(session: sqlalchemy.orm.Session, channels: [str]) -> [int]:
+    """
+    Find the channel buffers whose names match any of the given patterns.
+    :param session: Database session to use
+    :param channels: List of SQL LIKE patterns (matched case-insensitively)
+    :return: List of bufferids
+    """
+    query = session.query(Buffer.bufferid)\
+        .filter(Buffer.buffertype == BufferType.channel_buffer.value)\
+        .filter(or_(*(Buffer.buffername.ilike(channel) for channel in channels)))
+    return [bufferid for bufferid, in query]
+
+
 def query_qfuser(session: sqlalchemy.orm.Session, qfuserid: int) -> QfUser:
     """
     Find a user.
@@ -207,55 +1062,214 @@ def query_qfuser(session: sqlalchemy.orm.Session, qfuserid: int) -> QfUser:
         raise NotFound("No such user.") from e
 
 
-def query_permitted_buffers(session: sqlalchemy.orm.Session, user: QfUser) -> [int]:
+def query_permitted_buffers(session: sqlalchemy.orm.Session, user: QfUser) -> [Buffer]:
     """
     Return a list of buffers that the user is permitted to access.
 
     :param session: Database session to use
     :param user: User whose permissions to search
-    :return: List of Buffer objects
-    """
-    permissions = {
-        'users': tuple(perm for perm in user.permissions if perm.type == Type.user),
-        'networks': tuple(perm for perm in user.permissions if perm.type == Type.network),
-        'buffers': tuple(perm for perm in user.permissions if perm.type == Type.buffer),
-    }
-    permitted_buffers = []
-
-    for buffer in query_buffers(session, BufferType.channel_buffer):  # type: Buffer
-        # Priority 1: buffer match
-        try:
-            buffer_perm = next(perm for perm in permissions['buffers'] if perm.bufferid == buffer.bufferid)  \
-                # type: QfPermission
-            # If allow, add it to the list; if deny, short-circuit current buffer. Then continue to next buffer.
-            if buffer_perm.access is Access.allow:
-                permitted_buffers.append(buffer)
-            continue
-        except StopIteration:  # if next() doesn't find a match
-            pass
-
-        # Priority 2: network match
-        try:
-            network_perm = next(perm for perm in permissions['networks'] if perm.networkid == buffer.networkid) \
-                # type: QfPermission
-            if network_perm.access is Access.allow:
-                permitted_buffers.append(buffer)
-            continue
-        except StopIteration:  # if next() doesn't find a match
-            pass
-
-        try:
-            user_perm = next(perm for perm in permissions['users'] if perm.userid == buffer.network.userid) \
-                # type: QfPermission
-            if user_perm.access is Access.allow:
-                permitted_buffers.append(buffer)
-            continue
-        except StopIteration:  # if next() doesn't find a match
-            pass
+    :return: List of Buffer objects, ordered by name
+    """
+    return _build_query_permitted_buffers(session, user, Buffer).order_by(asc(Buffer.buffername)).all()
+
+
+def query_permitted_bufferids(session: sqlalchemy.orm.Session, user: QfUser) -> [int]:
+    """
+    Return the IDs of the buffers that the user is permitted to access. Permissions are resolved in a single query.
+
+    :param session: Database session to use
+    :param user: User whose permissions to search
+    :return: List of bufferids
+    """
+    return [bufferid for bufferid, in _build_query_permitted_buffers(session, user, Buffer.bufferid)]
+
+
+def is_user_unrestricted(user: QfUser) -> bool:
+    """
+    Check whether a user may access all channel buffers, i.e. the user's default access is allow (or the user is a
+    superuser) and the user has no deny permissions. Such users' searches don't need to be filtered by permissions.
+    :param user: User to check
+    :return:
+    """
+    return (user.access is Access.allow or user.is_superuser) and \
+        not any(perm.access is Access.deny for perm in user.permissions)
+
+
+_permitted_bufferids_cache = LruCache(max_size=1024)
+_permission_version = 0  # incremented to invalidate all users' cached permitted buffers
+_user_permission_versions = {}  # qfuserid: version, incremented to invalidate one user's cached permitted buffers
+_buffer_watermark = None  # (watermark, time checked)
+_cache_lock = threading.Lock()
+
+
+def query_permitted_bufferids_cached(session: sqlalchemy.orm.Session, user: QfUser, buffer_check_interval: float=60)\
+        -> frozenset:
+    """
+    Cached version of :func:`query_permitted_bufferids`. Results are cached per user, and are recomputed when:
+
+    * :func:`invalidate_permission_cache` is called (e.g. after a permission change in this process);
+    * the user's default access, superuser status or permissions differ from the cached entry (e.g. changed by another
+      worker process);
+    * new buffers appear in (or buffers are removed from) the Quassel database. This is checked at most once every
+      ``buffer_check_interval`` seconds.
+
+    :param session: Database session to use
+    :param user: User whose permissions to search
+    :param buffer_check_interval: Minimum time between checks of the buffer table for new buffers, in seconds.
+    :return: frozenset of bufferids
+    """
+    watermark = _get_buffer_watermark(session, buffer_check_interval)
+    key = (_permission_version, _user_permission_versions.get(user.qfuserid, 0), watermark,
+           _get_permission_fingerprint(user))
+    cached = _permitted_bufferids_cache.get(user.qfuserid)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    bufferids = frozenset(query_permitted_bufferids(session, user))
+    _permitted_bufferids_cache.set(user.qfuserid, (key, bufferids))
+    return bufferids
+
 
-        # default access value
-        if user.access is Access.allow or user.is_superuser:
-            permitted_buffers.append(buffer)
-        continue
+def invalidate_permission_cache(qfuserid: int=None):
+    """
+    Invalidate cached permitted buffers. Call this after changing a user's permissions, access or superuser status.
+    :param qfuserid: User to invalidate. If None, invalidates all users.
+    :return: None
+    """
+    global _permission_version
+    # versions are part of the cache key: an entry computed concurrently from the old permissions is never used
+    with _cache_lock:
+        if qfuserid is None:
+            _permission_version += 1
+        else:
+            _user_permission_versions[qfuserid] = _user_permission_versions.get(qfuserid, 0) + 1
+    if qfuserid is None:
+        _permitted_bufferids_cache.clear()
+    else:
+        _permitted_bufferids_cache.pop(qfuserid)
+
+
+def _get_permission_fingerprint(user: QfUser) -> tuple:
+    """ Return a hashable summary of everything affecting a user's permitted buffers (except the buffers table). """
+    return (user.access, user.is_superuser,
+            tuple(sorted((perm.type.value, perm.get_id(), perm.access.value) for perm in user.permissions)))
+
+
+def _get_buffer_watermark(session: sqlalchemy.orm.Session, check_interval: float) -> tuple:
+    """
+    Return (number of buffers, highest bufferid), re-querying the database at most every ``check_interval`` seconds.
+    """
+    global _buffer_watermark
+    now = time.monotonic()
+    with _cache_lock:
+        if _buffer_watermark is not None and now - _buffer_watermark[1] < check_interval:
+            return _buffer_watermark[0]
+    watermark = tuple(session.query(func.count(Buffer.bufferid), func.max(Buffer.bufferid)).one())
+    with _cache_lock:
+        _buffer_watermark = (watermark, now)
+    return watermark
+
+
+_buffer_names = {}  # bufferid: (buffername, networkname)
+_buffer_names_watermark = None  # (buffer watermark, time loaded)
+_sender_cache = LruCache(max_size=app.config.get('QF_SENDER_CACHE_SIZE', 100000))
+
+
+def get_buffer_names(session: sqlalchemy.orm.Session, bufferids, check_interval: float=60, ttl: float=300) \
+        -> {int: (str, str)}:
+    """
+    Get the buffer and network names of buffers, from a process-wide cache of the buffer and network tables. The cache
+    is reloaded when buffers are added or removed (see ``query_permitted_bufferids_cached()``), when a requested buffer
+    is missing, and every ``ttl`` seconds: renamed buffers and networks are shown under their old names until then.
+
+    :param session: Database session to use
+    :param bufferids: Iterable of bufferids that will be looked up in the result
+    :param check_interval: Minimum time between checks of the buffer table for added or removed buffers, in seconds.
+    :param ttl: Maximum time between reloads, in seconds.
+    :return: dict of {bufferid: (buffername, networkname)}, for all buffers. Treat as read-only.
+    """
+    global _buffer_names, _buffer_names_watermark
+    watermark = _get_buffer_watermark(session, check_interval)
+    now = time.monotonic()
+    with _cache_lock:
+        names = _buffer_names
+        is_current = _buffer_names_watermark is not None and _buffer_names_watermark[0] == watermark \
+            and now - _buffer_names_watermark[1] < ttl
+    if is_current and all(bufferid in names for bufferid in bufferids):
+        return names
+
+    query = session.query(Buffer.bufferid, Buffer.buffername, Network.networkname)\
+        .join(Network, Network.networkid == Buffer.networkid)
+    names = {bufferid: (sys.intern(buffername), sys.intern(networkname)) for bufferid, buffername, networkname in query}
+    with _cache_lock:
+        _buffer_names = names
+        _buffer_names_watermark = (watermark, now)
+    return names
+
+
+def get_senders(session: sqlalchemy.orm.Session, senderids) -> {int: str}:
+    """
+    Get sender strings (nick!user@host), using a process-wide LRU cache. Sender records don't change once created.
+
+    :param session: Database session to use
+    :param senderids: Iterable of senderids
+    :return: dict of {senderid: sender}
+    """
+    senders = {}
+    missing = []
+    for senderid in senderids:
+        sender = _sender_cache.get(senderid)
+        if sender is None:
+            missing.append(senderid)
+        else:
+            senders[senderid] = sender
+
+    if missing:
+        query = session.query(Sender.senderid, Sender.sender)\
+            .filter(Sender.senderid == any_(bindparam('senderids', missing, type_=ARRAY(Integer))))
+        for senderid, sender in query:
+            _sender_cache.set(senderid, sender)
+            senders[senderid] = sender
+    return senders
+
+
+def _build_query_permitted_buffers(session: sqlalchemy.orm.Session, user: QfUser, *entities) -> sqlalchemy.orm.Query:
+    """
+    Build a query for the channel buffers that the user is permitted to access, resolving the user's permissions in
+    SQL. For each buffer, the first matching permission in this order of priority applies:
+
+    1. A permission on the buffer itself;
+    2. A permission on the buffer's network;
+    3. A permission on the network's quassel user;
+    4. The user's default access (``QfUser.access``). Superusers default to allow.
+
+    :param session: Database session to use
+    :param user: User whose permissions to search
+    :param entities: Entities or columns to query (passed to ``session.query()``)
+    :return: SQLAlchemy query
+    """
+    perm_buffer = sqlalchemy.orm.aliased(QfPermission)
+    perm_network = sqlalchemy.orm.aliased(QfPermission)
+    perm_user = sqlalchemy.orm.aliased(QfPermission)
+    access = func.coalesce(perm_buffer.access, perm_network.access, perm_user.access)
+
+    query = session.query(*entities).select_from(Buffer)\
+        .join(Network, Network.networkid == Buffer.networkid)\
+        .outerjoin(perm_buffer, and_(perm_buffer.qfuserid == user.qfuserid,
+                                     perm_buffer.type == Type.buffer,
+                                     perm_buffer.bufferid == Buffer.bufferid))\
+        .outerjoin(perm_network, and_(perm_network.qfuserid == user.qfuserid,
+                                      perm_network.type == Type.network,
+                                      perm_network.networkid == Buffer.networkid))\
+        .outerjoin(perm_user, and_(perm_user.qfuserid == user.qfuserid,
+                                   perm_user.type == Type.user,
+                                   perm_user.userid == Network.userid))\
+        .filter(Buffer.buffertype == BufferType.channel_buffer.value)  # type: sqlalchemy.orm.query.Query
+
+    if user.access is Access.allow or user.is_superuser:
+        query = query.filter(or_(access == Access.allow, access.is_(None)))
+    else:
+        query = query.filter(access == Access.allow)
 
-    return permitted_buffers
+    # in case of duplicate permissions on the same buffer/network/user
+    return query.distinct()
@@ -4,6 +4,8 @@ Form input parameters parsing and conversion tools (for preparing and sanitising
 Project: QuasselFlask
 """
 
+import base64
+import binascii
 import re
 from datetime import datetime, timedelta
 from enum import Enum
@@ -11,6 +13,7 @@ from enum import Enum
 from wtforms import ValidationError
 
 import quasselflask
+from quasselflask.parsing.irclog import BacklogType, conversation_backlog_types
 from quasselflask.parsing.query import BooleanQuery
 
 
@@ -26,13 +29,21 @@ def process_search_params(in_args) -> dict:
     Keys returned:
 
     - query_wildcard: boolean - always set (default false)
+    - query_fulltext: boolean - whether to use a full-text search for the query (QF_FULLTEXT_SEARCH, and not wildcard)
     - limit: int - if not set, set to default value in configuration; limited to the max value in configuration
     - order: str - "newest" (default) or "oldest"
+    - context: int - number of lines of context to show before and after each result (default 0); limited to
+      QF_CONTEXT_MAX in configuration
     - start: datetime|None
     - end: datetime|None
     - channels: list (may be empty)
     - usermasks: list (may be empty)
     - query: quasselflask.parsing.query.BooleanQuery
+    - cursor: (datetime, int)|None - (time, messageid) of the page boundary record, see ``decode_search_cursor()``
+    - cursor_direction: str|None - "before" or "after" the ``cursor`` record (chronologically); None if no cursor
+    - type: SearchType - backlog (default) or usermask
+    - types: frozenset|None - message types to search (BacklogType), see ``parse_backlog_types()``; None for all types.
+      Defaults to the conversation types for backlog searches, and all types for usermask searches.
 
     :param in_args:
     :return:
@@ -41,6 +52,8 @@ def process_search_params(in_args) -> dict:
 
     # Unique arguments
     out_args['query_wildcard'] = bool(in_args.get('query_wildcard', None, int))
+    out_args['query_fulltext'] = \
+        not out_args['query_wildcard'] and bool(quasselflask.app.config.get('QF_FULLTEXT_SEARCH', False))
 
     out_args['limit'] = in_args.get('limit', quasselflask.app.config['RESULTS_NUM_DEFAULT'], int)
     if out_args['limit'] > quasselflask.app.config['RESULTS_NUM_MAX']:
@@ -50,6 +63,9 @@ def process_search_params(in_args) -> dict:
     if out_args['order'] not in ('newest', 'oldest'):
         out_args['order'] = 'newest'
 
+    out_args['context'] = in_args.get('context', 0, int)
+    out_args['context'] = max(0, min(out_args['context'], quasselflask.app.config['QF_CONTEXT_MAX']))
+
     out_args['start'] = None
     if in_args.get('start'):
         try:
@@ -65,6 +81,11 @@ def process_search_params(in_args) -> dict:
         except ValueError as e:
             raise ValueError('Invalid end time format: must be in YYYY-MM-DD HH:MM:SS.SSS format.') from e
 
+    out_args['cursor'] = None
+    out_args['cursor_direction'] = None
+    if in_args.get('cursor'):
+        out_args['cursor_direction'], out_args['cursor'] = decode_search_cursor(in_args.get('cursor'))
+
     # Flat-list arguments
     out_args['channels'] = extract_glob_list(in_args.get('channel', ''))
     out_args['usermasks'] = extract_glob_list(in_args.get('usermask', ''))
@@ -74,6 +95,9 @@ def process_search_params(in_args) -> dict:
     except KeyError:
         out_args['type'] = SearchType.backlog
 
+    out_args['types'] = parse_backlog_types(
+        in_args.get('types', ''), None if out_args['type'] is SearchType.usermask else conversation_backlog_types)
+
     # fulltext string
     out_args['query'] = BooleanQuery(in_args.get('query', ''), quasselflask.app.logger)
     out_args['query'].tokenize()
@@ -98,6 +122,69 @@ def convert_str_to_datetime(s: str) -> datetime:
     return datetime.strptime(norm_s, '-'.join(dt_format_arr[0:segments_count]))
 
 
+def parse_backlog_types(s: str, default: frozenset=conversation_backlog_types) -> frozenset:
+    """
+    Parse a list of message types to search, separated by spaces or commas. Each item is the name of a ``BacklogType``
+    (e.g. "privmsg"), "conversation" for ``conversation_backlog_types`` or "all" for all types.
+    :param s: Input string.
+    :param default: Types returned if the string is empty.
+    :return: frozenset of BacklogType, or None for all types.
+    :raise ValueError: Unknown message type.
+    """
+    types = set()
+    for name in re.split(r'[\s,]+', s.strip().lower()):
+        if not name:
+            continue
+        elif name == 'all':
+            return None
+        elif name == 'conversation':
+            types |= conversation_backlog_types
+        elif name in BacklogType.__members__:
+            types.add(BacklogType[name])
+        else:
+            raise ValueError('Invalid message type: {} (must be one of {}, conversation or all).'.format(
+                name, ', '.join(BacklogType.__members__)))
+    if not types:
+        return default
+    return frozenset(types) if len(types) < len(BacklogType) else None
+
+
+def encode_search_cursor(direction: str, time: datetime, messageid: int) -> str:
+    """
+    Encode a keyset pagination cursor into an opaque, URL-safe token. The cursor identifies a page boundary record by
+    its (time, messageid) sort key, which lets the next page be retrieved with an index seek instead of re-scanning
+    every result before it.
+
+    :param direction: "before" to retrieve records chronologically before the boundary record (older), "after" to
+        retrieve records after it (newer).
+    :param time: Boundary record's time.
+    :param messageid: Boundary record's messageid (tie-breaker for records with identical times).
+    :return: Opaque cursor token
+    """
+    if direction not in ('before', 'after'):
+        raise ValueError('Invalid cursor direction: ' + repr(direction))
+    raw = '{}|{}|{:d}'.format(direction[0], time.isoformat(), messageid)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_search_cursor(token: str) -> (str, (datetime, int)):
+    """
+    Decode a cursor token created by ``encode_search_cursor()``.
+
+    :param token: Opaque cursor token
+    :return: (direction, (time, messageid)), where direction is "before" or "after".
+    :raise ValueError: Token is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('ascii')
+        direction_str, time_str, messageid_str = raw.split('|')
+        direction = {'b': 'before', 'a': 'after'}[direction_str]
+        time_format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in time_str else '%Y-%m-%dT%H:%M:%S'
+        return direction, (datetime.strptime(time_str, time_format), int(messageid_str))
+    except (binascii.Error, UnicodeError, KeyError, ValueError) as e:
+        raise ValueError('Invalid page cursor.') from e
+
+
 def escape_like(s: str) -> str:
     """
     Escape special characters _ and % for LIKE queries, as well as the escape character '\'.
@@ -165,6 +252,28 @@ def convert_glob_to_like(s: str) -> (str, bool):
     return ''.join(s_parse), has_wildcards
 
 
+def convert_glob_to_like_substring(s: str) -> str:
+    """
+    Converts a glob-style wildcard string to an SQL LIKE pattern that matches it anywhere in a string (surrounded by %).
+    Consecutive % wildcards are collapsed into one, so that the pattern stays simple for trigram index lookups.
+    :param s: Glob string to convert.
+    :return: LIKE pattern, or None if the input is empty or only contains * wildcards (the pattern would match
+        anything, so no condition is needed).
+    """
+    if not s:
+        return None
+
+    like_str, _ = convert_glob_to_like(s)
+    # split into characters, keeping escape sequences together so that an escaped \% is not seen as a wildcard
+    pattern = []
+    for element in ['%'] + re.findall(r'\\.|.', like_str, re.DOTALL) + ['%']:
+        if element != '%' or not pattern or pattern[-1] != '%':
+            pattern.append(element)
+    if all(element == '%' for element in pattern):
+        return None
+    return ''.join(pattern)
+
+
 class PasswordValidator:
     def __init__(self, len_min=-1, len_max=-1, required_regex=(r'[A-Z]', r'[a-z]', r'[0-9]'), message=None):
         """
@@ -3,6 +3,7 @@ Tools for preparing IRC log results for display.
 
 Project: QuasselFlask
 """
+import functools
 from enum import Enum
 from datetime import datetime
 from flask import escape, Markup
@@ -38,6 +39,11 @@ class BacklogType(Enum):
     invite = 0x20000
 
 
+# Message types of conversation, as opposed to events (joins, parts, mode changes, etc.), which make up most of the
+# backlog of busy channels. Backlog searches only return these types by default.
+conversation_backlog_types = frozenset({BacklogType.privmsg, BacklogType.notice, BacklogType.action})
+
+
 class BufferType(Enum):
     """
     https://github.com/quassel/quassel/blob/master/src/common/bufferinfo.h
@@ -74,44 +80,82 @@ class Color(Enum):
 
 
 class DisplayRecordSenderMixin:
+    __slots__ = ('sender', 'nickname')
+
     def __init__(self, sender):
         self.sender = sender
         self.nickname = self.sender.split('!', 1)[0]  # type: str
 
     def get_nick_hash(self):
         """
-        Hashes the nick and returns a four-bit value. This method internally uses CRC16 x-25 implementation, which
-        corresponds to Quassel's implementation (qChecksum() on Quassel 0.10.0, Qt 4.8.5) according to a quick
-        empirical check (6 nicknames).
-
-        See: http://crcmod.sourceforge.net/crcmod.predefined.html
+        Hashes the nick and returns a four-bit value. See :func:`get_nick_hash`.
         :return:
         """
-        lower_nick = self.nickname.lower().rstrip('_')
-        stripped_nick = lower_nick.rstrip('_')
-        normalized_nick = stripped_nick if stripped_nick else lower_nick  # in case nickname is all underscores
-        return calculateNicknameHash(normalized_nick.encode('latin-1')) & 0xF
+        return get_nick_hash(normalize_nickname(self.nickname))
 
     def get_nick_color(self):
         """
-        Return the nick's colour based on hash. Corresponds to Quassel's own implementation.
+        Return the nick's colour based on hash. See :func:`get_nick_color`.
+        :return: Color object
+        """
+        return get_nick_color(normalize_nickname(self.nickname))
 
-        The colours will correspond in QuasselFlask's default colour scheme and in the Solarized Light/Dark themes for
-        Quassel by antoligy <https://github.com/antoligy/SolarizedQuassel>.
 
-        Otherwise, to make this work with other themes, you can customise the Color enum. Usually, Quassel supports 16
-        colours. If you want the colours here to correspond to your Quassel colour scheme, specify all 16 colours you
-        used in Quassel (or specify 8 colours - corresponds to repeating the list of 8 colours twice in Quassel's nick
-        colour settings).
+def normalize_nickname(nickname: str) -> str:
+    """
+    Normalise a nickname for hashing, as Quassel does: lowercase, and strip trailing underscores (unless the nickname is
+    all underscores).
+    :param nickname: Nickname
+    :return: Normalised nickname
+    """
+    lower_nick = nickname.lower()
+    stripped_nick = lower_nick.rstrip('_')
+    return stripped_nick if stripped_nick else lower_nick  # in case nickname is all underscores
 
-        For Quassel's hash implementation, see:
-        https://github.com/quassel/quassel/blob/6509162911c0ceb3658f6a7ece1a1d82c97b577e/src/uisupport/uistyle.cpp#L874
-        :return: Color object
-        """
-        return Color(self.get_nick_hash() % len(Color))
+
+@functools.lru_cache(maxsize=4096)
+def get_nick_hash(normalized_nick: str) -> int:
+    """
+    Hashes the nick and returns a four-bit value. This method internally uses CRC16 x-25 implementation, which
+    corresponds to Quassel's implementation (qChecksum() on Quassel 0.10.0, Qt 4.8.5) according to a quick
+    empirical check (6 nicknames).
+
+    Characters that can't be encoded in latin-1 are replaced by '?', like Qt's QString::toLatin1().
+
+    Results are cached process-wide, as the same few nicknames usually appear on every line of a results page.
+
+    See: http://crcmod.sourceforge.net/crcmod.predefined.html
+    :param normalized_nick: Nickname, normalised by :func:`normalize_nickname`
+    :return:
+    """
+    return calculateNicknameHash(normalized_nick.encode('latin-1', errors='replace')) & 0xF
+
+
+@functools.lru_cache(maxsize=4096)
+def get_nick_color(normalized_nick: str) -> 'Color':
+    """
+    Return the nick's colour based on hash. Corresponds to Quassel's own implementation.
+
+    The colours will correspond in QuasselFlask's default colour scheme and in the Solarized Light/Dark themes for
+    Quassel by antoligy <https://github.com/antoligy/SolarizedQuassel>.
+
+    Otherwise, to make this work with other themes, you can customise the Color enum. Usually, Quassel supports 16
+    colours. If you want the colours here to correspond to your Quassel colour scheme, specify all 16 colours you
+    used in Quassel (or specify 8 colours - corresponds to repeating the list of 8 colours twice in Quassel's nick
+    colour settings).
+
+    For Quassel's hash implementation, see:
+    https://github.com/quassel/quassel/blob/6509162911c0ceb3658f6a7ece1a1d82c97b577e/src/uisupport/uistyle.cpp#L874
+    :param normalized_nick: Nickname, normalised by :func:`normalize_nickname`
+    :return: Color object
+    """
+    return Color(get_nick_hash(normalized_nick) % len(Color))
 
 
 class DisplayBacklog(DisplayRecordSenderMixin):
+    # slots: many instances are created per search (up to RESULTS_NUM_MAX)
+    __slots__ = ('messageid', 'time', 'network', 'channel', 'type', '_message')
+    _backlog_types = {backlog_type.value: backlog_type for backlog_type in BacklogType}
     _icon_type_map = {
         BacklogType.privmsg: '',
         BacklogType.notice: '',
@@ -159,18 +203,20 @@ class DisplayBacklog(DisplayRecordSenderMixin):
         _ = s.format(datetime.now())  # test if valid - may throw IndexError or KeyError on invalid specification
         cls._time_format = s
 
-    def __init__(self, backlog):
+    def __init__(self, backlog, sender: str=None, channel: str=None, network: str=None):
         """
-        :param backlog: Backlog object
+        :param backlog: Backlog object, or a row with at least the messageid, time, type and message columns (see
+            ``quasselflask.models.query.backlog_row_columns``)
+        :param sender: Sender string (nick!user@host). If None, taken from the backlog's sender relationship.
+        :param channel: Buffer name. If None, taken from the backlog's buffer relationship.
+        :param network: Network name. If None, taken from the backlog's buffer relationship.
         """
-        DisplayRecordSenderMixin.__init__(self, backlog.sender.sender)
+        DisplayRecordSenderMixin.__init__(self, sender if sender is not None else backlog.sender.sender)
+        self.messageid = backlog.messageid  # type: int
         self.time = DisplayBacklog._time_format.format(backlog.time)  # type: str
-        self.network = backlog.buffer.network.networkname  # type: str
-        self.channel = backlog.buffer.buffername  # type: str
-        try:
-            self.type = BacklogType(backlog.type)
-        except ValueError:
-            self.type = BacklogType.privmsg
+        self.network = network if network is not None else backlog.buffer.network.networkname  # type: str
+        self.channel = channel if channel is not None else backlog.buffer.buffername  # type: str
+        self.type = self._backlog_types.get(backlog.type, BacklogType.privmsg)
         self._message = backlog.message  # type: str
 
     def get_icon_text(self):
@@ -244,125 +290,120 @@ class DisplayBacklog(DisplayRecordSenderMixin):
         Convert IRC formatting into HTML.
         :return: HTML string
         """
-        irc_chars = DisplayBacklog._format_chars
-
-        safe_msg = escape(self.get_message())
-        in_msg_tokens = DisplayBacklog._format_re.split(safe_msg)  # simple tokenize!
-        out_msg_tokens = []
-
-        nesting = 0
-        state = {
-            'bold': False,
-            'italic': False,
-            'underline': False,
-            'color': False
-        }
-        color_processing = False
-        color_processing_arg = 0
-        color_args = [None, None]
-
-        for token in in_msg_tokens:
-            if color_processing:
-                try:
-                    color_args[color_processing_arg] = int(token)
-                except (ValueError, TypeError):
-                    color_args[color_processing_arg] = None
-                color_processing_arg += 1
-
-                # end condition
-                if color_processing_arg >= 2:
-                    self._add_html_close_tag(out_msg_tokens, state)
-                    state['color'] = True if any(color_args) else False
-                    color_processing = False
-                    color_processing_arg = 0
-                    self._add_html_open_tag(out_msg_tokens, state, color_args)
-
-            elif token and (token[0] in irc_chars):
-                c = token[0]
-                if c == '\x02':
-                    self._add_html_close_tag(out_msg_tokens, state)
-                    state['bold'] = not state['bold']
-                    self._add_html_open_tag(out_msg_tokens, state, color_args)
-                elif c == '\x1d':
-                    self._add_html_close_tag(out_msg_tokens, state)
-                    state['italic'] = not state['italic']
-                    self._add_html_open_tag(out_msg_tokens, state, color_args)
-                elif c == '\x1f':
-                    self._add_html_close_tag(out_msg_tokens, state)
-                    state['underline'] = not state['underline']
-                    self._add_html_open_tag(out_msg_tokens, state, color_args)
-                elif c == '\x03':
-                    color_processing = True
-                    color_processing_arg = 0
-                elif c == '\x16':
-                    if state['color']:  # only if colour is applied right now
-                        self._add_html_close_tag(out_msg_tokens, state)
-                        color_args[0], color_args[1] = color_args[1], color_args[0]
-                        self._add_html_open_tag(out_msg_tokens, state, color_args)
-                elif c == '\x0f':
-                    self._add_html_close_tag(out_msg_tokens, state)
-                    state = {k: False for k in state}
-                else:
-                    raise ValueError('Bad formatting character - '
-                                     'did you change _format_chars and forget to update format_html_message()?')
-            else:  # not a special character
-                if token:  # we only filter None/empty string here because None is valuable for colour processing
-                    out_msg_tokens.append(token)
-
-        # if any formatting still applied at the end, close the last tag
-        self._add_html_close_tag(out_msg_tokens, state)
-        return Markup(''.join(out_msg_tokens))
-
-    @staticmethod
-    def _add_html_open_tag(output: list, state: {str: bool}, color_args=(None, None)):
-        """
-        Add HTML opening tag for the currently enabled formatting options (in ``state`` plus ``color_args``) to
-        ``output``. Used by format_html_message(). If no formatting options enabled, does nothing.
-        :param output: the current list of output tokens so far
-        :param state: The formatting flags to be applied.
-        :param color_args: Color arguments, a 2-element addressable collection (e.g. tuple or list).
-        :return: True if an open tag was added, False otherwise (because no formatting enabled)
-        """
-        classes = []
-
-        for name, enabled in state.items():
-            if enabled and name != 'color':
-                classes.append('irc-{}'.format(name))
-            elif enabled and name == 'color' and any(color_args):
-                try:
-                    classes.append('irc-color{:02d}'.format(color_args[0]))
-                    classes.append('irc-bgcolor{:02d}'.format(color_args[1]))
-                except (ValueError, TypeError):
-                    # no colour, I guess! None (no arg) and invalid strings
-                    # foreground colour may be set at this point even if background colour is None/invalid
-                    # that behaviour is intended: no need for cleanup here
-                    pass
-
-        if classes:
-            output.append('<span class="{}">'.format(' '.join(classes)))
-            return True
-        return False
-
-    @staticmethod
-    def _add_html_close_tag(output: list, pre_state: {str: bool}):
-        """
-        Add an HTML closing tag if any formatting options are enabled now in ``pre-state``, which represents the
-        formatting state before the closing tag is added. This state is not modified - it is the responsibility of the
-        caller to update the state after the formatting is closed.
-
-        In the case that ``output`` contains an opening tag as its last element, and thus adding this close tag would
-        create a redundant/empty element, this redundant element is removed instead.
-        :param output: the current list of output tokens so far
-        :param pre_state: the formatting options state (enabled/disabled) before the close tag is added
-        :return: True if anything was added or redundant tags removed, False if not (because nothing applied)
-        """
-        if any(pre_state.values()):  # close tag only if formatting had previously been applied
-            if output and output[-1].startswith('<span'):  # redundant element
-                output.pop()
+        return format_html_message(self.get_message())
+
+
+# Formatting state bits used by format_html_message()
+_bold = 0x1
+_italic = 0x2
+_underline = 0x4
+_color = 0x8
+
+# CSS classes for each combination of the bold/italic/underline bits
+_html_style_classes = tuple(' '.join(name for bit, name in ((_bold, 'irc-bold'), (_italic, 'irc-italic'),
+                                                            (_underline, 'irc-underline')) if flags & bit)
+                            for flags in range(_color))
+
+
+def _get_html_color_classes(fg, bg) -> str:
+    if fg is None:
+        return ''  # background only (after a swap) isn't displayed
+    elif bg is None:
+        return 'irc-color{:02d}'.format(fg)
+    else:
+        return 'irc-color{:02d} irc-bgcolor{:02d}'.format(fg, bg)
+
+
+# CSS classes for each (foreground, background) colour pair
+_html_color_classes = {(fg, bg): _get_html_color_classes(fg, bg)
+                       for fg in (None,) + tuple(range(1, 16)) for bg in (None,) + tuple(range(1, 16))}
+_format_chars_re = re.compile('[' + ''.join(DisplayBacklog._format_chars) + ']')
+
+
+@functools.lru_cache(maxsize=4096)
+def format_html_message(message: str) -> Markup:
+    """
+    Convert IRC formatting into HTML. Results are cached, as the same messages often recur (bots, joins/quits, etc.).
+    :param message: Message with IRC formatting characters
+    :return: HTML string
+    """
+    safe_msg = escape(message)
+    if not _format_chars_re.search(message):  # most messages have no formatting
+        return safe_msg
+
+    # tokens: text, then (formatting char, colour 1, colour 2, text) for each formatting char
+    tokens = DisplayBacklog._format_re.split(safe_msg)
+    out_msg_tokens = [tokens[0]] if tokens[0] else []
+    flags = 0
+    fg = bg = None
+    is_open = False  # whether a <span> is open: not always the case with formatting applied (see _add_html_open_tag)
+
+    for i in range(1, len(tokens), 4):
+        c = tokens[i][0]
+        if c != '\x16' or flags & _color:  # swap only if colour is applied right now
+            _add_html_close_tag(out_msg_tokens, is_open)
+            if c == '\x02':
+                flags ^= _bold
+            elif c == '\x1d':
+                flags ^= _italic
+            elif c == '\x1f':
+                flags ^= _underline
+            elif c == '\x03':
+                fg = int(tokens[i + 1]) if tokens[i + 1] else None
+                bg = int(tokens[i + 2]) if tokens[i + 2] else None
+                flags = (flags | _color) if fg or bg else (flags & ~_color)
+            elif c == '\x16':
+                fg, bg = bg, fg
+            elif c == '\x0f':
+                flags = 0
             else:
-                output.append('</span>')
-            return True
-        return False
+                raise ValueError('Bad formatting character - '
+                                 'did you change _format_chars and forget to update format_html_message()?')
+            is_open = _add_html_open_tag(out_msg_tokens, flags, fg, bg)
+
+        if tokens[i + 3]:
+            out_msg_tokens.append(tokens[i + 3])
+
+    # if any formatting still applied at the end, close the last tag
+    _add_html_close_tag(out_msg_tokens, is_open)
+    return Markup(''.join(out_msg_tokens))
+
+
+def _add_html_open_tag(output: list, flags: int, fg: int, bg: int) -> bool:
+    """
+    Add HTML opening tag for the formatting ``flags`` and colours to ``output``. Used by format_html_message(). If no
+    formatting is displayed (none enabled, or only a background colour after a swap), does nothing.
+    :param output: the current list of output tokens so far
+    :param flags: formatting state bits
+    :param fg: foreground colour number, or None
+    :param bg: background colour number, or None
+    :return: True if an opening tag was added, False otherwise
+    """
+    classes = _html_style_classes[flags & ~_color]
+    if flags & _color:
+        color_classes = _html_color_classes[fg, bg]
+        if color_classes:
+            classes = classes + ' ' + color_classes if classes else color_classes
+    if classes:
+        output.append('<span class="' + classes + '">')
+        return True
+    return False
+
+
+def _add_html_close_tag(output: list, is_open: bool):
+    """
+    Add an HTML closing tag if a tag is open (``is_open``, as returned by the last _add_html_open_tag() call). If
+    ``output`` ends with an opening tag, and thus adding this close tag would create an empty element, that opening tag
+    is removed instead. Used by format_html_message().
+    :param output: the current list of output tokens so far
+    :param is_open: whether an opening tag is open
+    :return: None
+    """
+    if is_open:
+        if output and output[-1].startswith('<span'):  # redundant element
+            output.pop()
+        else:
+            output.append('</span>')
 
 
 class DisplayUserSummary(DisplayRecordSenderMixin):
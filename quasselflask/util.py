@@ -6,6 +6,9 @@ Project: QuasselFlask
 
 import random
 import string
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import urlparse, urljoin
 
 # NOTE: This file is imported very early in the startup process, when some Flask objects (like app) may not have been
@@ -124,3 +127,89 @@ def log_action_error(action: str, msg: str, *args: tuple):
     logmsg = 'ERROR [QFUSER={user.qfuserid:d} {user.username}] {action} {params}: {errmsg}' \
         .format(user=current_user, action=action, params=str_params, errmsg=msg)
     return logmsg
+
+
+class LruCache:
+    """
+    Thread-safe, size-bounded cache with least-recently-used eviction, and optional expiry of entries after a
+    time-to-live. Suitable for process-wide caches shared between requests.
+
+    The cache can optionally be bounded by total weight (e.g. approximate memory use) of its entries, as well as by
+    number of entries.
+    """
+    _missing = object()
+
+    def __init__(self, max_size=128, ttl=None, max_weight=None, weigher=None):
+        """
+        :param max_size: Maximum number of entries. When exceeded, the least recently used entry is evicted.
+        :param ttl: Default time-to-live of entries, in seconds. None for no expiry.
+        :param max_weight: Maximum total weight of entries. When exceeded, the least recently used entries are evicted.
+            None for no limit.
+        :param weigher: Callable taking (key, value) and returning the weight of an entry. Required if max_weight is
+            set.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigher = weigher
+        self.weight = 0
+        self._data = OrderedDict()  # key: (value, expiry time or None, weight)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get a value from the cache, marking it as recently used.
+        :param key: Key to look up
+        :param default: Value to return if the key is not in the cache or has expired.
+        :return:
+        """
+        with self._lock:
+            value, expiry, _ = self._data.get(key, (self._missing, None, 0))
+            if value is self._missing:
+                return default
+            if expiry is not None and expiry <= time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=_missing):
+        """
+        Add or replace a value in the cache, evicting the least recently used entries if the cache is full. Entries
+        heavier than ``max_weight`` are not cached.
+        :param key: Key
+        :param value: Value
+        :param ttl: Time-to-live of this entry in seconds, or None for no expiry. If not given, uses the cache's
+            default.
+        :return: None
+        """
+        if ttl is self._missing:
+            ttl = self.ttl
+        expiry = time.monotonic() + ttl if ttl is not None else None
+        weight = self.weigher(key, value) if self.weigher else 0
+        with self._lock:
+            self._remove(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self._data[key] = (value, expiry, weight)
+            self.weight += weight
+            while len(self._data) > self.max_size or (self.max_weight is not None and self.weight > self.max_weight):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        """ Remove an entry from the cache and return its value (or ``default`` if not present). """
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def _remove(self, key, default=None):
+        value, _, weight = self._data.pop(key, (default, None, 0))
+        self.weight -= weight
+        return value
+
+    def __len__(self):
+        return len(self._data)
@@ -327,6 +327,7 @@ def admin_update_user_superuser(user):
     user.superuser = bool(data.get('value', '0') == '1')
     flash('Set user {} as {}'.format(user.username, 'superuser' if user.superuser else 'normal user'), 'notice')
     db.session.commit()
+    invalidate_permission_cache(user.qfuserid)
     logger.info(log_action('update user', ('user', _get_qfuser_log(user)),
                            ('set', 'superuser'), ('to', repr(user.superuser))))
     return safe_redirect(get_next_url('POST'))
@@ -410,6 +411,7 @@ def admin_permissions(userid):
             ))
 
         db.session.commit()
+        invalidate_permission_cache(user.qfuserid)
 
         logger.info(log_action('update permissions', ('user', _get_qfuser_log(user)),
                                ('default', user.access), ('permissions', user.permissions)))
@@ -496,6 +498,7 @@ def admin_delete_user(userid):
         db.session.delete(user)
         flash('Deleted user {}'.format(user.username))
         db.session.commit()
+        invalidate_permission_cache(user.qfuserid)
         logger.info(log_action('delete user', ('user', _get_qfuser_log(user))))
         return redirect(url_for('admin_users'))
 
@@ -4,12 +4,17 @@ Main flask endpoints for this application.
 Project: QuasselFlask
 """
 
+import csv
+import io
+import itertools
+import json
 import time
+import zlib
+from datetime import datetime, timedelta
 
-from flask import Response, flash, request, g, render_template, url_for, redirect
+from flask import Response, abort, flash, request, g, render_template, url_for, redirect, stream_with_context
 from flask_sqlalchemy import get_debug_queries
 from flask_user import login_required, current_user
-from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest, NotFound
 
 import quasselflask
@@ -17,8 +22,8 @@ from quasselflask import app, db, userman
 from quasselflask.adapters import ghostlid
 from quasselflask.adapters.email_adapter import send_confirm_email_email
 from quasselflask.models.query import *
-from quasselflask.parsing.form import process_search_params, SearchType
-from quasselflask.parsing.irclog import DisplayBacklog, DisplayUserSummary
+from quasselflask.parsing.form import process_search_params, encode_search_cursor, SearchType
+from quasselflask.parsing.irclog import BufferType, DisplayBacklog, DisplayUserSummary
 from quasselflask.util import safe_redirect, get_next_url, log_access, log_action, log_action_error, repr_user_input
 
 logger = app.logger  # type: logging.Logger
@@ -100,31 +105,32 @@ def search():
     try:
         sql_args, render_args = _process_search_form_params()
         sql_args['limit'] += 1  # so we know if there are more results
-    except BadRequest:
-        return redirect(url_for('home'))
+    except BadRequest as e:
+        return e.response if e.response is not None else redirect(url_for('home'))
 
     render_args['search_type'] = SearchType.backlog
+    is_streamed = app.config['QF_STREAM_RESULTS'] and not sql_args['context']
 
     # build and execute the query
-    results_cursor = build_query_backlog(db.session, sql_args,
-                                         query_options=(joinedload(Backlog.sender),
-                                                        joinedload(Backlog.buffer).joinedload(Buffer.network))).all()
+    # if streaming, only get the keys of the results here: the full records are loaded while the page is sent
+    results_cursor = _search_backlog(sql_args, backlog_key_columns if is_streamed else backlog_row_columns)
+
+    # check if we have more results available than the passed limit (note that we queried for limit+1 results)
+    # the extra record is the last one in query order, so trim it before reversing into chronological order
+    render_args['more_results'] = False
+    if len(results_cursor) == sql_args['limit']:  # this limit was already incremented
+        results_cursor = results_cursor[0:-1]  # only show up to the user-entered limit
+        render_args['more_results'] = True  # for template
 
     # reversed() if we're doing newest-first because we still want chronological order
-    if sql_args['order'] == 'newest':
+    if is_order_descending(sql_args):
         results_raw = list(reversed(results_cursor))
     else:
         results_raw = list(results_cursor)
 
-    # check if we have more results available than the passed limit (note that we queried for limit+1 results)
-    render_args['more_results'] = False
-    if len(results_raw) == sql_args['limit']:  # this limit was already incremented
-        results_raw = results_raw[0:-1]  # only show up to the user-entered limit
-        render_args['more_results'] = True  # for template
+    render_args.update(_get_page_links(sql_args, results_raw, render_args['more_results']))
 
-    # set up display
-    results_display = [DisplayBacklog(result) for result in results_raw]
-    render_args['search_results_total'] = len(results_display)
+    render_args['search_results_total'] = len(results_raw)
 
     if (app.debug or app.testing) and get_debug_queries():
         for info in get_debug_queries():
@@ -133,7 +139,33 @@ def search():
 
     render_args['expand_line_details'] = _is_expand_line_details(sql_args, results_raw)
 
-    return render_template('results.html', records=results_display, **render_args)
+    # set up display
+    if sql_args['context']:
+        results_display, render_args['context_starts'], render_args['context_hits'] = \
+            _get_display_backlog_context(results_raw, sql_args['context'])
+        return render_template('results.html', records=results_display, **render_args)
+    elif is_streamed:
+        records = stream_backlog_by_messageids(db.session, [result.messageid for result in results_raw],
+                                               backlog_row_columns)
+        results_display = _get_display_backlog(results_raw, records)
+        return Response(stream_with_context(_stream_template('results.html', records=results_display, **render_args)))
+    else:
+        results_display = list(_get_display_backlog(results_raw))
+        return render_template('results.html', records=results_display, **render_args)
+
+
+def _stream_template(template_name: str, **context):
+    """
+    Render a template as a stream, like ``render_template()``. Used to send large pages to the browser as they are
+    rendered, e.g. with ``stream_with_context()``.
+    :param template_name: Name of the template
+    :param context: Template variables
+    :return: Iterator of rendered strings
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(50)
+    return stream
 
 
 def _do_search_text() -> str:
@@ -146,24 +178,26 @@ def _do_search_text() -> str:
     try:
         sql_args, _ = _process_search_form_params()
     except BadRequest:
-        return Response('400 Bad Request', status=400, mimetype='text/plain')
+        abort(Response('400 Bad Request', status=400, mimetype='text/plain'))
 
     # build and execute the query
-    results_cursor = build_query_backlog(db.session, sql_args,
-                                         query_options=(joinedload(Backlog.sender),
-                                                        joinedload(Backlog.buffer).joinedload(Buffer.network))).all()
+    results_cursor = _search_backlog(sql_args)
 
     # reversed() if we're doing newest-first because we still want chronological order
-    if sql_args['order'] == 'newest':
+    if is_order_descending(sql_args):
         results_raw = list(reversed(results_cursor))
     else:
         results_raw = list(results_cursor)
 
     # set up display
-    results_display = [DisplayBacklog(result) for result in results_raw]
     expand_line_details = _is_expand_line_details(sql_args, results_raw)
-    results_text = render_template('results.txt', records=results_display, expand_line_details=expand_line_details)
-    return results_text
+    if sql_args['context']:
+        results_display, context_starts, _ = _get_display_backlog_context(results_raw, sql_args['context'])
+        return render_template('results.txt', records=results_display, expand_line_details=expand_line_details,
+                               context_starts=context_starts)
+    else:
+        results_display = list(_get_display_backlog(results_raw))
+        return render_template('results.txt', records=results_display, expand_line_details=expand_line_details)
 
 
 @app.route('/search/logs/text')
@@ -183,6 +217,134 @@ def search_paste(duration):
     return Response(url, mimetype='text/plain', status=200)
 
 
+# format: (mimetype, file extension)
+_export_formats = {
+    'txt': ('text/plain', 'txt'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+_export_fields = ('time', 'network', 'channel', 'type', 'sender', 'message')  # for data formats (ndjson, csv)
+
+
+@app.route('/search/logs/export')
+@login_required
+def search_export():
+    """
+    Export all results of a backlog search as a file download, in chronological order. Unlike the other search
+    endpoints, the number of results isn't limited: results are streamed from a server-side cursor as they are sent.
+
+    Takes the same query parameters as ``search()`` (except ``limit``, ``order`` and ``cursor``, which are ignored),
+    plus:
+
+    * `format`: `txt` (default), `ndjson` or `csv`.
+    * `gzip`: If `1`, the file is gzip-compressed.
+    """
+    export_format = request.args.get('format', 'txt')
+    if export_format not in _export_formats:
+        raise BadRequest('Invalid export format.')
+    is_gzip = request.args.get('gzip', 0, int) == 1
+
+    try:
+        sql_args, _ = _process_search_form_params()
+    except BadRequest:
+        return Response('400 Bad Request', status=400, mimetype='text/plain')
+    sql_args.update(limit=None, order='oldest', cursor=None, cursor_direction=None)
+
+    logger.info(log_action('export search', ('format', export_format), ('gzip', is_gzip)))
+    mimetype, extension = _export_formats[export_format]
+    chunks = _export_backlog(sql_args, export_format, app.config['QF_EXPORT_BATCH_SIZE'])
+    if is_gzip:
+        chunks = _gzip_stream(chunks)
+        mimetype, extension = 'application/gzip', extension + '.gz'
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=quasselflask-{:%Y%m%d-%H%M%S}.{}'.format(
+        datetime.now(), extension)
+    return response
+
+
+def _export_backlog(sql_args: dict, export_format: str, batch_size: int):
+    """
+    Generator that executes a backlog search and yields the formatted results, one batch at a time. Results are fetched
+    from a server-side cursor, so memory use is bounded by ``batch_size`` regardless of the number of results.
+
+    If the generator is closed early (e.g. the client disconnected), the query is stopped.
+    :param sql_args: Processed search args, as returned by ``_process_search_form_params()``, with no limit.
+    :param export_format: Key of ``_export_formats``
+    :param batch_size: Number of results to fetch and format at a time
+    :return: Generator of str
+    """
+    num_results = 0
+    try:
+        if export_format == 'csv':
+            yield _format_export_csv([_export_fields])
+        if is_search_empty(sql_args):
+            return
+
+        results = iter(build_query_backlog(db.session, sql_args, entities=backlog_row_columns).yield_per(batch_size))
+        while True:
+            batch = list(itertools.islice(results, batch_size))
+            if not batch:
+                break
+            records = list(_get_display_backlog(batch))
+            if export_format == 'txt':
+                yield render_template('results.txt', records=records, expand_line_details=True)
+            elif export_format == 'ndjson':
+                yield ''.join(json.dumps(row, ensure_ascii=False) + '\n'
+                              for row in _get_export_rows(batch, records, as_dict=True))
+            else:
+                yield _format_export_csv(_get_export_rows(batch, records))
+            num_results += len(batch)
+        logger.info(log_action('export search complete', ('results', num_results)))
+    except GeneratorExit:
+        logger.info(log_action('export search cancelled', ('results', num_results)))
+        raise
+    finally:
+        db.session.close()  # ends the transaction, and with it the server-side cursor
+
+
+def _get_export_rows(results: list, records: [DisplayBacklog], as_dict=False):
+    """
+    Get the fields of results for data export formats (``_export_fields``). The message is the original message,
+    including any IRC formatting characters.
+    :param results: Result rows (``backlog_row_columns``)
+    :param records: DisplayBacklog for each result
+    :param as_dict: If True, yield dicts keyed by field name; otherwise, tuples.
+    :return: Generator of tuple or dict
+    """
+    for result, record in zip(results, records):
+        row = (result.time.isoformat(), record.network, record.channel, record.type.name, record.sender,
+               result.message)
+        if as_dict:
+            yield dict(zip(_export_fields, row))
+        else:
+            yield row
+
+
+def _format_export_csv(rows) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def _gzip_stream(chunks):
+    """
+    Gzip-compress a stream of strings (encoded as UTF-8).
+    :param chunks: Iterable of str. Closed when this generator is closed.
+    :return: Generator of bytes
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip container
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
 @app.route('/search/users')
 @login_required
 def search_users():
@@ -191,13 +353,16 @@ def search_users():
     try:
         sql_args, render_args = _process_search_form_params()
         # not doing the +1 trick to check if more results, because of the grouping+summing that happens here
-    except BadRequest:
-        return redirect(url_for('home'))
+    except BadRequest as e:
+        return e.response if e.response is not None else redirect(url_for('home'))
 
     render_args['search_type'] = SearchType.usermask
 
-    # build and execute the query
-    results_cursor = build_query_usermask(db.session, sql_args).all()
+    # build and execute the query, unless no permitted buffers match the search
+    if is_search_empty(sql_args):
+        results_cursor = []
+    else:
+        results_cursor = build_query_usermask(db.session, sql_args).all()
 
     if (app.debug or app.testing) and get_debug_queries():
         info = get_debug_queries()[0]
@@ -216,16 +381,19 @@ def _do_search_users_text():
     try:
         sql_args, render_args = _process_search_form_params()
     except BadRequest:
-        return Response('400 Bad Request', status=400, mimetype='text/plain')
+        abort(Response('400 Bad Request', status=400, mimetype='text/plain'))
 
-    # build and execute the query
-    results_cursor = build_query_usermask(db.session, sql_args).all()
+    # build and execute the query, unless no permitted buffers match the search
+    if is_search_empty(sql_args):
+        results_cursor = []
+    else:
+        results_cursor = build_query_usermask(db.session, sql_args).all()
     results_raw = list(results_cursor)
     results_display = [DisplayUserSummary(sender, count) for sender, count in results_raw]
     render_args['search_results_total'] = sum(record.count for record in results_display)
-    render_args['col_len_nickname'] = max(len(record.nickname) for record in results_display)
-    render_args['col_len_sender'] = max(len(record.sender) for record in results_display)
-    render_args['col_len_count'] = max(len(str(record.count)) for record in results_display)
+    render_args['col_len_nickname'] = max((len(record.nickname) for record in results_display), default=0)
+    render_args['col_len_sender'] = max((len(record.sender) for record in results_display), default=0)
+    render_args['col_len_count'] = max((len(str(record.count)) for record in results_display), default=0)
     results_text = render_template('results_users.txt', records=results_display, **render_args)
     return results_text
 
@@ -247,6 +415,55 @@ def search_users_paste(duration):
     return Response(url, mimetype='text/plain', status=200)
 
 
+def _search_backlog(sql_args: dict, entities=backlog_row_columns) -> list:
+    """
+    Execute a backlog search, using the configured search windows and result cache.
+    :param sql_args: Processed search args, as returned by ``_process_search_form_params()``.
+    :param entities: Columns to query: ``backlog_row_columns``, or ``backlog_key_columns`` to load only the keys of the
+        results.
+    :return: List of result rows (of ``entities``), in query order (see ``is_order_descending()``).
+    """
+    # no permitted buffers or no senders match the search
+    if is_search_empty(sql_args):
+        return []
+
+    sql_args = dict(sql_args, plan=choose_backlog_plan(db.session, sql_args, app.config['QF_BUFFER_STATS_TTL']))
+    app.logger.debug("Search plan: %s", sql_args['plan'])
+    return search_backlog_cached(db.session, sql_args,
+                                 windows=[timedelta(days=days) for days in app.config['QF_SEARCH_WINDOWS']],
+                                 ttl=app.config['QF_RESULT_CACHE_TTL'], entities=entities)
+
+
+def _get_display_backlog(results: list, records=None):
+    """
+    Prepare backlog results for display. Buffer, network and sender names come from in-process caches, rather than
+    being loaded with each result.
+    :param results: Result rows, as returned by ``_search_backlog()``
+    :param records: Iterable of full result rows (``backlog_row_columns``) to display, if ``results`` only contains the
+        keys of the results. These are only iterated when the return value is.
+    :return: Generator of DisplayBacklog
+    """
+    buffer_names = get_buffer_names(db.session, {result.bufferid for result in results},
+                                    app.config['QF_PERMISSION_CACHE_BUFFER_CHECK'], app.config['QF_BUFFER_NAMES_TTL'])
+    senders = get_senders(db.session, {result.senderid for result in results})
+    return (DisplayBacklog(record, senders.get(record.senderid, ''), *buffer_names.get(record.bufferid, ('', '')))
+            for record in (records if records is not None else results))
+
+
+def _get_display_backlog_context(results: list, num_context: int) -> ([DisplayBacklog], {int}, {int}):
+    """
+    Prepare backlog results with the context of each result for display. Overlapping contexts are merged.
+    :param results: Result rows, as returned by ``_search_backlog()``, in chronological order
+    :param num_context: Number of lines before and after each result
+    :return: (DisplayBacklog of all lines, in display order; messageids of the first line of each context; messageids of
+        the results)
+    """
+    contexts = query_backlog_contexts(db.session, results, num_context)
+    records = [record for context in contexts for record in context]
+    return list(_get_display_backlog(records)), {context[0].messageid for context in contexts}, \
+        {result.messageid for result in results}
+
+
 def _process_search_form_params() -> (dict, dict):
     """
     Process the params in request.args. This method is a wrapper method that a) outputs useful debugging messages; and
@@ -254,11 +471,13 @@ def _process_search_form_params() -> (dict, dict):
     template to prepopulate the form.
     :return: Two dicts: first is sql args, second is render (template) args after sanitisation. See ``search()`` for
         example usage of this function.
-    :raise BadRequest: set of search parameters is invalid
+    :raise BadRequest: set of search parameters is invalid. If there are search parameters but they can't be processed
+        (e.g. invalid time format or page cursor), the exception's ``response`` is the search form with an error
+        message.
     """
     # some helpful constants for the request argument processing
     # type of extraction/processing - this is more documentation as it's not used to process at the moment
-    unique_args = {'start', 'end', 'limit', 'query_wildcard'}
+    unique_args = {'start', 'end', 'limit', 'query_wildcard', 'cursor', 'types'}
     list_wildcard_args = {'channel', 'usermask'}  # space-separated lists; if any arg repeated, list is concatenated
     query_args = {'query'}  # requires query parsing
     search_args = unique_args | list_wildcard_args | query_args
@@ -280,17 +499,29 @@ def _process_search_form_params() -> (dict, dict):
         'search_query_wildcard': form_args.get('search_query_wildcard', int),
         'search_limit': form_args.get('limit', app.config['RESULTS_NUM_DEFAULT'], int),
         'search_order': form_args.get('order'),
+        'search_context': form_args.get('context', 0, int),
         'search_type': form_args.get('type'),
+        'search_types': form_args.get('types'),
         'expand_line_details': False,
     }
 
     # Process and parse the args
     try:
         sql_args = process_search_params(form_args)
-        sql_args['permissions'] = query_permitted_buffers(db.session, current_user)
+        if is_user_unrestricted(current_user):
+            sql_args['permissions'] = None
+        else:
+            sql_args['permissions'] = query_permitted_bufferids_cached(
+                db.session, current_user, app.config['QF_PERMISSION_CACHE_BUFFER_CHECK'])
+        sql_args['bufferids'] = resolve_search_bufferids(db.session, sql_args)
+        sql_args['senderids'] = resolve_search_senderids(
+            db.session, sql_args, app.config['QF_USERMASK_SENDERIDS_MAX'], app.config['QF_USERMASK_CACHE_TTL'])
+        if app.config['QF_MESSAGEID_TIME_RANGE']:
+            sql_args['messageid_range'] = resolve_search_messageid_range(db.session, sql_args)
     except ValueError as e:
         errtext = e.args[0]
-        return render_template('search_form.html', error=errtext, **render_args)
+        raise BadRequest(errtext, response=Response(
+            render_template('search_form.html', error=errtext, **render_args), status=400))
 
     app.logger.debug("Args|SQL: limit=%i order=%s channel%s usermask%s start[%s] end[%s] query%s %s",
                      sql_args['limit'], sql_args['order'], sql_args['channels'], sql_args['usermasks'],
@@ -298,16 +529,60 @@ def _process_search_form_params() -> (dict, dict):
                      sql_args['end'].isoformat() if sql_args['end'] else '',
                      sql_args['query'].get_parsed(), '[wildcard]' if sql_args['query_wildcard'] else '[no_wildcard]')
 
-    app.logger.debug("Permissions: {}".format(', '.join(str(pbuf.bufferid) for pbuf in sql_args['permissions'])))
+    if sql_args['bufferids'] is None:
+        app.logger.debug("Buffers: all permitted")
+    else:
+        app.logger.debug("Buffers: {}".format(', '.join(str(bufferid) for bufferid in sorted(sql_args['bufferids']))))
+    if sql_args['senderids'] is not None:
+        app.logger.debug("Senders: {}".format(', '.join(str(senderid) for senderid in sorted(sql_args['senderids']))))
 
     # update after processing params
     render_args['search_query_wildcard'] = sql_args.get('query_wildcard')
     render_args['search_limit'] = sql_args.get('limit')
     render_args['search_order'] = sql_args.get('order')
+    render_args['search_context'] = sql_args.get('context')
     render_args['search_type'] = sql_args.get('type')
     return sql_args, render_args
 
 
+def _get_page_links(sql_args: dict, results: [Backlog], more_results: bool) -> dict:
+    """
+    Build the keyset pagination cursors and links to the older and newer pages of a backlog search.
+
+    :param sql_args: Processed search args, as returned by ``_process_search_form_params()``.
+    :param results: Raw results from the query, in chronological order.
+    :param more_results: Whether the query found more results than the limit, in query order.
+    :return: Dict of render args: ``cursor_older``, ``cursor_newer`` (opaque cursor tokens) and ``page_older_url``,
+        ``page_newer_url``. Each is None if there is no such page.
+    """
+    page_args = {
+        'cursor_older': None,
+        'cursor_newer': None,
+        'page_older_url': None,
+        'page_newer_url': None,
+    }
+    if not results:
+        return page_args
+
+    # In query order, the limit+1 check tells us whether there are more results. In the other direction, there are more
+    # results if we got here via a cursor (at the very least, there's the cursor's boundary record).
+    if is_order_descending(sql_args):
+        has_older, has_newer = more_results, bool(sql_args.get('cursor'))
+    else:
+        has_older, has_newer = bool(sql_args.get('cursor')), more_results
+
+    url_args = request.args.to_dict()
+    if has_older:
+        page_args['cursor_older'] = url_args['cursor'] = \
+            encode_search_cursor('before', results[0].time, results[0].messageid)
+        page_args['page_older_url'] = url_for('search', **url_args)
+    if has_newer:
+        page_args['cursor_newer'] = url_args['cursor'] = \
+            encode_search_cursor('after', results[-1].time, results[-1].messageid)
+        page_args['page_newer_url'] = url_for('search', **url_args)
+    return page_args
+
+
 def _is_expand_line_details(sql_args: dict, results: [Backlog]) -> bool:
     """
     Check the query and results to see if the backlog results should be expanded by default.
@@ -432,5 +707,46 @@ def user_update():
 
 
 @app.route('/context/<int:post_id>/<int:num_context>')
+@login_required
 def context(post_id, num_context):
-    pass  # TODO context endpoint
+    """
+    Show a backlog message in context: up to ``num_context`` lines before and after the message, in the same buffer.
+    :param post_id: Message ID
+    :param num_context: Number of lines before and after the message. Limited to half of ``RESULTS_NUM_MAX``.
+    """
+    results_display = _get_context_backlog(post_id, num_context)
+    target = next(record for record in results_display if record.messageid == post_id)
+    return render_template('context.html', records=results_display, post_id=post_id, num_context=num_context,
+                           search_channel=target.channel)
+
+
+@app.route('/context/<int:post_id>/<int:num_context>/text')
+@login_required
+def context_text(post_id, num_context):
+    results_display = _get_context_backlog(post_id, num_context)
+    results_text = render_template('results.txt', records=results_display, expand_line_details=False)
+    return Response(results_text, mimetype='text/plain', status=200)
+
+
+def _get_context_backlog(post_id: int, num_context: int) -> [DisplayBacklog]:
+    """
+    Get a backlog message and its context, for display.
+    :param post_id: Message ID
+    :param num_context: Number of lines before and after the message
+    :return:
+    :raise NotFound: the message doesn't exist, or the current user isn't permitted to view its buffer (the two cases
+        aren't distinguished, so as not to reveal the existence of messages)
+    """
+    num_context = min(num_context, app.config['RESULTS_NUM_MAX'] // 2)
+    message_buffer = query_message_buffer(db.session, post_id)
+    if message_buffer is None or message_buffer.buffertype != BufferType.channel_buffer.value:
+        raise NotFound()
+    if not is_user_unrestricted(current_user) and message_buffer.bufferid not in query_permitted_bufferids_cached(
+            db.session, current_user, app.config['QF_PERMISSION_CACHE_BUFFER_CHECK']):
+        logger.info(log_action_error('context', 'buffer not permitted', ('messageid', post_id),
+                                     ('bufferid', message_buffer.bufferid)))
+        raise NotFound()
+
+    results = query_backlog_context(db.session, message_buffer.bufferid, post_id, num_context, num_context,
+                                    backlog_row_columns)
+    return list(_get_display_backlog(results))
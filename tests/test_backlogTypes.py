@@ -0,0 +1,38 @@
+"""
+Search message type parameter tests.
+
+Project: QuasselFlask
+"""
+
+from unittest import TestCase
+
+from quasselflask.parsing.form import parse_backlog_types
+from quasselflask.parsing.irclog import BacklogType, conversation_backlog_types
+
+
+class TestBacklogTypes(TestCase):
+    def test_parse(self):
+        test_cases = [
+            ('privmsg', {BacklogType.privmsg}),
+            ('join part', {BacklogType.join, BacklogType.part}),
+            (' Join,  PART,', {BacklogType.join, BacklogType.part}),
+            ('conversation', conversation_backlog_types),
+            ('conversation topic', conversation_backlog_types | {BacklogType.topic}),
+        ]
+        for s, expected in test_cases:
+            self.assertEqual(parse_backlog_types(s), expected, repr(s))
+
+    def test_all(self):
+        self.assertIsNone(parse_backlog_types('all'))
+        self.assertIsNone(parse_backlog_types('privmsg all'))
+        self.assertIsNone(parse_backlog_types(' '.join(BacklogType.__members__)))
+
+    def test_default(self):
+        self.assertEqual(parse_backlog_types(''), conversation_backlog_types)
+        self.assertEqual(parse_backlog_types(' , '), conversation_backlog_types)
+        self.assertIsNone(parse_backlog_types('', None))
+
+    def test_invalid(self):
+        for s in ['privmsgs', 'join 1', 'events']:
+            with self.assertRaises(ValueError, msg=repr(s)):
+                parse_backlog_types(s)
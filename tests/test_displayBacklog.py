@@ -7,7 +7,9 @@ import re
 from datetime import datetime
 from unittest import TestCase
 
-from quasselflask.parsing.irclog import DisplayBacklog
+from markupsafe import Markup
+
+from quasselflask.parsing.irclog import DisplayBacklog, format_html_message
 
 FORMAT_TAG = '<span class="([^"]+)">'
 
@@ -17,9 +19,12 @@ class TestDisplayBacklog(TestCase):
         class Dummy:
             pass
         dummy = Dummy()
+        dummy.messageid = 1
         dummy.time = datetime(1970, 1, 1)
         dummy.buffer = Dummy()
         dummy.buffer.buffername = 'channel'
+        dummy.buffer.network = Dummy()
+        dummy.buffer.network.networkname = 'network'
         dummy.sender = Dummy()
         dummy.sender.sender = 'sender'
         dummy.type = 0
@@ -141,3 +146,72 @@ class TestDisplayBacklog(TestCase):
                                     "\nFailed on test: " + repr(irc_input) +
                                     "\nOutput: " + result +
                                     "\nTag #{:d} should have class '{}'".format(i+1, expected_class))
+
+    def test_format_html_message_unformatted(self):
+        # messages without formatting characters are only escaped
+        test_cases = [
+            ('', ''),
+            ('Hello mirror so glad to see you my friend', 'Hello mirror so glad to see you my friend'),
+            ('<b>bold?</b> & "quoted"', '&lt;b&gt;bold?&lt;/b&gt; &amp; &#34;quoted&#34;'),
+            ('\x01ACTION\x01 \x04', '\x01ACTION\x01 \x04'),  # control characters that aren't IRC formatting
+        ]
+        for irc_input, expected in test_cases:
+            result = format_html_message(irc_input)
+            self.assertIsInstance(result, Markup, repr(irc_input))
+            self.assertEqual(str(result), expected, repr(irc_input))
+
+    def test_format_html_message_exact(self):
+        # full expected output, for nesting, reset and swap of formatting
+        test_cases = [
+            (  # nested formatting, each closed in reverse order
+                '\x02b \x1dbi \x1fbiu\x1f bi\x1d b\x02 none',
+                '<span class="irc-bold">b </span><span class="irc-bold irc-italic">bi </span>'
+                '<span class="irc-bold irc-italic irc-underline">biu</span><span class="irc-bold irc-italic"> bi</span>'
+                '<span class="irc-bold"> b</span> none'
+            ),
+            (  # colour nested in bold, colour reset keeps bold
+                '\x02b \x0304,12colour\x03 b\x02 none',
+                '<span class="irc-bold">b </span><span class="irc-bold irc-color04 irc-bgcolor12">colour</span>'
+                '<span class="irc-bold"> b</span> none'
+            ),
+            (  # reset of all nested formatting, then new formatting
+                '\x02\x1d\x0304bic\x0f none \x1fu\x0f\x0f none',
+                '<span class="irc-bold irc-italic irc-color04">bic</span> none '
+                '<span class="irc-underline">u</span> none'
+            ),
+            (  # reset and toggles with no text in between: no empty elements
+                '\x02\x0f\x1d\x1dnone\x02\x02',
+                'none'
+            ),
+            (  # swap with background colour
+                '\x0304,12c \x16swapped\x16 c',
+                '<span class="irc-color04 irc-bgcolor12">c </span>'
+                '<span class="irc-color12 irc-bgcolor04">swapped</span>'
+                '<span class="irc-color04 irc-bgcolor12"> c</span>'
+            ),
+            (  # swap without background colour: no colour shown, tags still balanced
+                '\x0304c \x16none\x16 c\x03 none',
+                '<span class="irc-color04">c </span>none<span class="irc-color04"> c</span> none'
+            ),
+            (  # formatting and escaped text
+                '\x02<b>&\x02',
+                '<span class="irc-bold">&lt;b&gt;&amp;</span>'
+            ),
+        ]
+        for irc_input, expected in test_cases:
+            self.assertEqual(str(format_html_message(irc_input)), expected, repr(irc_input))
+
+    def test_format_html_message_cache(self):
+        # the same message, from different records, returns the same cached markup
+        message = 'Cached \x02bold\x02 and \x0304colour\x03 for a test'
+        first = format_html_message(message)
+        hits = format_html_message.cache_info().hits
+        self.assertIs(format_html_message(message), first)
+        self.dut._message = message
+        self.assertIs(self.dut.format_html_message(), first)
+        self.assertEqual(format_html_message.cache_info().hits, hits + 2)
+
+        # a different message isn't a cache hit
+        other = format_html_message(message + '!')
+        self.assertEqual(format_html_message.cache_info().hits, hits + 2)
+        self.assertEqual(str(other), str(first) + '!')
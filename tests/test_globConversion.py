@@ -0,0 +1,29 @@
+"""
+Glob to LIKE pattern conversion tests.
+
+Project: QuasselFlask
+"""
+
+from unittest import TestCase
+
+from quasselflask.parsing.form import convert_glob_to_like_substring
+
+
+class TestGlobConversion(TestCase):
+    def test_convert_glob_to_like_substring(self):
+        test_cases = [
+            ('abc', '%abc%'),  # no wildcards
+            ('*abc*', '%abc%'),  # leading/trailing wildcards collapsed into surrounding %
+            ('a**b', '%a%b%'),  # consecutive wildcards collapsed
+            ('a?b', '%a_b%'),
+            ('a\\*b', '%a*b%'),  # escaped wildcard is literal
+            ('a%b_c', '%a\\%b\\_c%'),  # LIKE special characters escaped
+            ('a\\\\*', '%a\\\\%'),  # escaped backslash followed by wildcard
+            ('?', '%_%'),  # single-character wildcard still requires a character
+        ]
+        for glob, expected in test_cases:
+            self.assertEqual(convert_glob_to_like_substring(glob), expected, repr(glob))
+
+    def test_convert_glob_to_like_substring_match_all(self):
+        for glob in ['', None, '*', '***']:
+            self.assertIsNone(convert_glob_to_like_substring(glob), repr(glob))
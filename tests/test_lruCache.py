@@ -0,0 +1,57 @@
+"""
+LruCache tests.
+
+Project: QuasselFlask
+"""
+
+import time
+from unittest import TestCase
+
+from quasselflask.util import LruCache
+
+
+class TestLruCache(TestCase):
+    def test_get_set(self):
+        cache = LruCache(max_size=4)
+        cache.set('a', 1)
+        cache.set('b', None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b', 'default'), "cached None is distinct from missing")
+        self.assertEqual(cache.get('c', 'default'), 'default')
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+
+    def test_eviction(self):
+        cache = LruCache(max_size=3)
+        for key in 'abc':
+            cache.set(key, key)
+        cache.get('a')  # 'b' is now least recently used
+        cache.set('d', 'd')
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get('b'))
+        for key in 'acd':
+            self.assertEqual(cache.get(key), key)
+
+    def test_ttl(self):
+        cache = LruCache(max_size=4, ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=None)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'), "expired")
+        self.assertEqual(cache.get('b'), 2, "no expiry")
+
+    def test_max_weight(self):
+        cache = LruCache(max_size=10, max_weight=10, weigher=lambda key, value: len(value))
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.set('a', 'aaa')  # replacing an entry replaces its weight
+        self.assertEqual(cache.weight, 7)
+        cache.set('c', 'cccc')  # evicts 'b'
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'aaa')
+        cache.set('d', 'd' * 11)  # too heavy to cache
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(len(cache), 2)
+        cache.pop('a')
+        self.assertEqual(cache.weight, 4)
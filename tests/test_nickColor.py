@@ -0,0 +1,35 @@
+"""
+Nickname colour tests.
+
+Project: QuasselFlask
+"""
+
+from unittest import TestCase
+
+from quasselflask.parsing.irclog import Color, DisplayRecordSenderMixin, get_nick_color, get_nick_hash, \
+    normalize_nickname
+
+
+class TestNickColor(TestCase):
+    def test_normalize_nickname(self):
+        self.assertEqual(normalize_nickname('Nick__'), 'nick')
+        self.assertEqual(normalize_nickname('Ni_ck'), 'ni_ck')
+        self.assertEqual(normalize_nickname('___'), '___')
+
+    def test_nick_color(self):
+        record = DisplayRecordSenderMixin('Nick_!user@host')
+        self.assertIsInstance(record.get_nick_color(), Color)
+        self.assertEqual(record.get_nick_color(), get_nick_color('nick'))
+        self.assertEqual(record.get_nick_hash(), DisplayRecordSenderMixin('NICK!u@h').get_nick_hash())
+
+    def test_non_latin1_nick(self):
+        self.assertEqual(get_nick_hash('ник'), get_nick_hash('???'), "unencodable characters hash as '?'")
+        self.assertIsInstance(DisplayRecordSenderMixin('Ник!user@host').get_nick_color(), Color)
+
+    def test_cached(self):
+        get_nick_color.cache_clear()
+        get_nick_hash.cache_clear()
+        for _ in range(100):
+            for nick in ('alice', 'bob'):
+                DisplayRecordSenderMixin(nick + '!user@host').get_nick_color()
+        self.assertEqual(get_nick_hash.cache_info().misses, 2)
@@ -0,0 +1,34 @@
+"""
+Search pagination cursor tests.
+
+Project: QuasselFlask
+"""
+
+from datetime import datetime
+from unittest import TestCase
+
+from quasselflask.parsing.form import encode_search_cursor, decode_search_cursor
+
+
+class TestSearchCursor(TestCase):
+    def test_round_trip(self):
+        test_cases = [
+            ('before', datetime(2016, 1, 3, 14, 0, 0), 1),
+            ('after', datetime(2016, 1, 3, 14, 0, 0, 123456), 123456789),
+            ('before', datetime(1970, 1, 1), 0),
+        ]
+        for direction, time, messageid in test_cases:
+            token = encode_search_cursor(direction, time, messageid)
+            self.assertRegex(token, r'^[A-Za-z0-9_-]+$', "token is URL-safe: " + repr(token))
+            self.assertEqual(decode_search_cursor(token), (direction, (time, messageid)),
+                             "round trip: " + repr((direction, time, messageid)))
+
+    def test_invalid_direction(self):
+        with self.assertRaises(ValueError):
+            encode_search_cursor('sideways', datetime(2016, 1, 3), 1)
+
+    def test_malformed(self):
+        for token in ['', 'garbage', '!!!', encode_search_cursor('after', datetime(2016, 1, 3), 1)[:-4],
+                      'eHwyMDE2LTAxLTAzVDAwOjAwOjAwfDE']:  # 'x|2016-01-03T00:00:00|1' (invalid direction)
+            with self.assertRaises(ValueError, msg=repr(token)):
+                decode_search_cursor(token)
@@ -0,0 +1,46 @@
+"""
+Search view tests. These need a QuasselFlask instance configured with a database (see QF_CONFIG_PATH in the README),
+and are skipped otherwise.
+
+Project: QuasselFlask
+"""
+
+from datetime import datetime
+from unittest import TestCase, SkipTest
+
+from flask_login import login_user
+
+import quasselflask
+
+
+class TestSearchViews(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.app = quasselflask.init_app()
+        except Exception as e:
+            raise SkipTest('QuasselFlask instance not available: {}'.format(e))
+
+    def get(self, url: str):
+        """ Request a URL as a logged-in (unsaved) user, and return the response. """
+        from quasselflask.models.models import QfUser
+        from quasselflask.models.types import PermissionAccess
+        with self.app.test_request_context(url):
+            login_user(QfUser(qfuserid=0, username='test', email='test@example.com', password='', active=True,
+                              superuser=True, access=PermissionAccess.allow, confirmed_at=datetime.utcnow()))
+            return self.app.full_dispatch_request()
+
+    def test_invalid_cursor(self):
+        for cursor in ['garbage', 'eHwyMDE2LTAxLTAzVDAwOjAwOjAwfDE']:
+            response = self.get('/search/logs?channel=%23test&cursor=' + cursor)
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertIn(b'Invalid page cursor', response.get_data(), cursor)
+            for url in ['/search/logs/text', '/search/logs/export']:
+                self.assertEqual(self.get(url + '?channel=%23test&cursor=' + cursor).status_code, 400, url)
+
+    def test_invalid_types(self):
+        response = self.get('/search/logs?channel=%23test&types=privmsg+bogus')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'Invalid message type: bogus', response.get_data())
+        for url in ['/search/logs/text', '/search/logs/export', '/search/users', '/search/users/text']:
+            self.assertEqual(self.get(url + '?channel=%23test&types=bogus').status_code, 400, url)